@@ -0,0 +1,84 @@
+"""
+Compare decoding pgvector embedding strings with ast.literal_eval (the old
+indexing path, which parsed every string twice) against
+index_utils.decode_embeddings.
+
+Usage:
+    python benchmarks/bench_embedding_decode.py
+    python benchmarks/bench_embedding_decode.py --documents 5000 --dim 1536
+
+Synthetic '[x,y,...]' strings like the ones Supabase returns for vector
+columns are decoded by both paths; wall time and peak Python memory
+(tracemalloc, measured in a second run) are reported, and the results are
+checked to be identical.
+"""
+import os
+import sys
+import ast
+import time
+import argparse
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from index_utils import decode_embeddings
+
+
+def make_documents(count, dim, seed=0):
+    rng = np.random.default_rng(seed)
+    vectors = rng.standard_normal((count, dim), dtype=np.float32)
+    return [
+        {"id": f"doc-{i}", "embedding": "[" + ",".join(repr(float(value)) for value in vector) + "]"}
+        for i, vector in enumerate(vectors)
+    ]
+
+
+def decode_with_literal_eval(documents):
+    """The previous path: one literal_eval per document for vectors, another for ids."""
+    vectors = []
+    for doc in documents:
+        vectors.append(ast.literal_eval(doc["embedding"]))
+    embeddings = np.array(vectors).astype("float32")
+    doc_ids = []
+    for doc in documents:
+        ast.literal_eval(doc["embedding"])
+        doc_ids.append(str(doc["id"]))
+    return doc_ids, embeddings
+
+
+def measure(fn, documents):
+    # Timed without tracemalloc, which slows allocation-heavy code down a lot
+    start = time.perf_counter()
+    result = fn(documents)
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    fn(documents)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, seconds, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark embedding string decoding")
+    parser.add_argument("--documents", type=int, default=2000, help="Number of embeddings")
+    parser.add_argument("--dim", type=int, default=1536, help="Embedding dimension")
+    args = parser.parse_args()
+
+    documents = make_documents(args.documents, args.dim)
+    print(f"{args.documents} embeddings x {args.dim} dims\n")
+    print(f"{'decoder':<18} {'seconds':>8} {'peak MB':>8}")
+
+    results = {}
+    for name, fn in (("literal_eval x2", decode_with_literal_eval), ("decode_embeddings", decode_embeddings)):
+        results[name], seconds, peak = measure(fn, documents)
+        print(f"{name:<18} {seconds:>8.2f} {peak / 2**20:>8.1f}")
+
+    (old_ids, old_matrix), (new_ids, new_matrix) = results.values()
+    assert old_ids == new_ids and np.array_equal(old_matrix, new_matrix), "decoders disagree"
+    print("\nresults identical")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Compare Gemini extraction latency and throughput across batch sizes.
+
+Usage:
+    python benchmarks/bench_gemini_batching.py path/to/file.pdf --batch-sizes 1 2 4 8
+    python benchmarks/bench_gemini_batching.py path/to/file.pdf --simulate
+
+With --simulate, Gemini is replaced by a stub whose latency is a fixed
+per-request overhead plus a per-page cost, so batch sizes can be compared
+without an API key. Without it, real requests are made with GEMINI_API_KEY.
+"""
+import os
+import sys
+import time
+import argparse
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gemini
+from page_cache import PageCache
+
+
+class SimulatedResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class SimulatedModel:
+    """Stand-in for genai.GenerativeModel that echoes page markers back."""
+
+    request_overhead = 0.8
+    per_page = 0.3
+
+    def __init__(self, *args, **kwargs):
+        self.requests = 0
+        self._lock = threading.Lock()
+
+    def generate_content(self, content):
+        with self._lock:
+            self.requests += 1
+        markers = [part for part in content if isinstance(part, str) and part.startswith("--- ")]
+        pages = max(1, len(markers))
+        time.sleep(self.request_overhead + self.per_page * pages)
+        if not markers:
+            return SimulatedResponse("Simulated page summary.")
+        return SimulatedResponse("\n".join(f"{marker}\nSimulated page summary." for marker in markers))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Gemini multi-page batching")
+    parser.add_argument("pdf_path", help="PDF to extract")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--concurrency", type=int, default=gemini.GEMINI_MAX_CONCURRENCY)
+    parser.add_argument("--simulate", action="store_true", help="Use a simulated model instead of the Gemini API")
+    args = parser.parse_args()
+
+    # Disable the page cache so every run actually hits the model
+    gemini.page_cache = PageCache(cache_dir=None, memory_items=0)
+
+    if args.simulate:
+        os.environ.setdefault("GEMINI_API_KEY", "simulated")
+        # Measure batching alone, not the shared rate budgets
+        gemini.scheduler = gemini.GeminiScheduler(requests_per_minute=0, tokens_per_minute=0, max_in_flight=args.concurrency)
+
+    # Render once so the comparison only measures extraction
+    pages = list(gemini.iter_pages_from_pdf(args.pdf_path))
+    print(f"{len(pages)} pages, {sum(len(p) for p, _ in pages)} bytes\n")
+    print(f"{'batch':>5} {'requests':>8} {'seconds':>8} {'pages/s':>8}")
+
+    for batch_size in args.batch_sizes:
+        model = SimulatedModel()
+        if args.simulate:
+            gemini.model = model
+
+        start = time.perf_counter()
+        gemini.extract_text_summary_from_images(pages, max_concurrency=args.concurrency, batch_pages=batch_size)
+        elapsed = time.perf_counter() - start
+
+        requests = model.requests if args.simulate else "-"
+        print(f"{batch_size:>5} {requests:>8} {elapsed:>8.2f} {len(pages) / elapsed:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Measure page payload size and extraction latency for image preprocessing settings.
+
+Usage:
+    python benchmarks/bench_image_preprocessing.py path/to/file.pdf
+    python benchmarks/bench_image_preprocessing.py path/to/photo.jpg --extract
+
+Every setting is applied to the same pages. PDF pages are shrunk the way the
+renderer does it (gemini._render_page with preprocess): the page is rendered
+straight to RGB or grayscale pixels, cropped, downscaled and JPEG-encoded
+once, so "prep s" includes rendering for every row. Image files go through
+gemini.preprocess_image, which decodes and re-encodes the upload. Payload
+bytes and preprocessing time are always reported; with --extract each setting
+is also sent to Gemini (GEMINI_API_KEY required) and the extraction latency
+and output length are reported so OCR quality can be compared side by side.
+"""
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fitz
+from PIL import Image
+
+import gemini
+from page_cache import PageCache
+
+# (label, max_dimension, grayscale, jpeg_quality, autocrop)
+SETTINGS = [
+    ("original", None, None, None, None),
+    ("crop only", 0, False, 95, True),
+    ("2048px q80", 2048, False, 80, True),
+    ("2048px gray q80", 2048, True, 80, True),
+    ("1600px q75", 1600, False, 75, True),
+    ("1600px gray q70", 1600, True, 70, True),
+    ("1200px gray q60", 1200, True, 60, True),
+]
+
+
+def render_pdf(path, max_dimension=None, grayscale=None, quality=None, autocrop=None, original=False, dpi=300):
+    """Rasterize every page (ignoring the text layer) as the render workers do"""
+    with fitz.open(path) as doc:
+        if original:
+            return [(gemini._render_page(page, dpi, use_text_layer=False), f"page_{i + 1}") for i, page in enumerate(doc)]
+        pages = []
+        for i, page in enumerate(doc):
+            pix = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY if grayscale else fitz.csRGB)
+            img = Image.frombytes("L" if grayscale else "RGB", (pix.width, pix.height), pix.samples)
+            del pix
+            pages.append((gemini._shrink_image(img, max_dimension, quality, autocrop), f"page_{i + 1}"))
+        return pages
+
+
+def apply_setting(path, pages, setting):
+    name, max_dimension, grayscale, quality, autocrop = setting
+    if path.lower().endswith(".pdf"):
+        return render_pdf(path, max_dimension, grayscale, quality, autocrop, original=name == "original")
+    if name == "original":
+        return pages
+    return [
+        (gemini.preprocess_image(data, max_dimension, grayscale, quality, autocrop), label)
+        for data, label in pages
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark page image preprocessing")
+    parser.add_argument("path", help="PDF or image file")
+    parser.add_argument("--extract", action="store_true", help="Also measure Gemini extraction latency")
+    args = parser.parse_args()
+
+    # Disable the page cache so every setting actually hits the model
+    gemini.page_cache = PageCache(cache_dir=None, memory_items=0)
+
+    pages = None if args.path.lower().endswith(".pdf") else gemini.read_image_file(args.path)
+    original_pages = apply_setting(args.path, pages, SETTINGS[0])
+    print(f"{len(original_pages)} pages\n")
+    header = f"{'setting':<18} {'bytes':>10} {'ratio':>6} {'prep s':>7}"
+    if args.extract:
+        header += f" {'extract s':>9} {'chars':>7}"
+    print(header)
+
+    original_bytes = sum(len(data) for data, _ in original_pages)
+    for setting in SETTINGS:
+        name = setting[0]
+        start = time.perf_counter()
+        processed = apply_setting(args.path, pages, setting)
+        prep_seconds = time.perf_counter() - start
+        total_bytes = sum(len(data) for data, _ in processed)
+
+        row = f"{name:<18} {total_bytes:>10} {total_bytes / original_bytes:>6.2f} {prep_seconds:>7.2f}"
+        if args.extract:
+            start = time.perf_counter()
+            summary = gemini.extract_text_summary_from_images(processed)
+            row += f" {time.perf_counter() - start:>9.2f} {len(summary):>7}"
+        print(row)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Measure recall@k against query latency for the FAISS index types the index
+builder chooses from (Flat, HNSW, IVF-SQ8), plus IVF-Flat and IVF-PQ for
+comparison, on synthetic vectors.
+
+Usage:
+    python benchmarks/bench_index_recall.py
+    python benchmarks/bench_index_recall.py --vectors 100000 --dim 1536 --k 8 --pq
+
+Vectors are drawn around random cluster centres in a low-dimensional latent
+space and projected up (real embeddings are clustered and have far fewer
+effective dimensions than coordinates, which is what makes IVF and HNSW work),
+then normalized like OpenAI embeddings.
+Exact neighbours come from the Flat index; every other index is swept over its
+search parameter (efSearch or nprobe) and its recall@k (share of the exact top k
+found), mean query latency and serialized size are reported. The spec
+index_utils.choose_index_spec would pick for each recall target is printed too.
+"""
+import os
+import sys
+import time
+import argparse
+
+import faiss
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from index_utils import choose_index_spec, create_index, apply_search_params
+
+
+def make_vectors(count, dim, clusters, seed, latent_dim=128, spread=2.0):
+    # Points around cluster centres in a low-dimensional latent space, projected
+    # up to dim with a little isotropic noise: like real embeddings, the data
+    # has far fewer effective dimensions than coordinates
+    rng = np.random.default_rng(0)
+    centres = rng.standard_normal((clusters, latent_dim), dtype=np.float32)
+    projection = rng.standard_normal((latent_dim, dim), dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    latent = centres[rng.integers(0, clusters, count)] + spread * rng.standard_normal((count, latent_dim), dtype=np.float32)
+    vectors = latent @ projection
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors += 0.1 / np.sqrt(dim) * rng.standard_normal((count, dim), dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def build(spec, vectors):
+    index = create_index(spec, vectors.shape[1])
+    start = time.perf_counter()
+    if spec["train_size"]:
+        index.train(vectors[:spec["train_size"]])
+    index.add_with_ids(vectors, np.arange(len(vectors), dtype="int64"))
+    return index, time.perf_counter() - start
+
+
+def recall_at_k(found, exact):
+    k = exact.shape[1]
+    return np.mean([len(set(row_found) & set(row_exact)) / k for row_found, row_exact in zip(found, exact)])
+
+
+def search(index, queries, k):
+    start = time.perf_counter()
+    _, found = index.search(queries, k)
+    return found, (time.perf_counter() - start) / len(queries) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark FAISS index recall vs latency")
+    parser.add_argument("--vectors", type=int, default=30_000, help="Corpus size")
+    parser.add_argument("--dim", type=int, default=1536, help="Embedding dimension")
+    parser.add_argument("--queries", type=int, default=200, help="Number of queries")
+    parser.add_argument("--k", type=int, default=8, help="Neighbours per query")
+    parser.add_argument("--clusters", type=int, default=200, help="Cluster centres in the synthetic data")
+    parser.add_argument("--pq", action="store_true", help="Also measure IVF-PQ (slow to train)")
+    args = parser.parse_args()
+
+    faiss.omp_set_num_threads(1)  # per-query latency as seen by one request
+    vectors = make_vectors(args.vectors, args.dim, args.clusters, seed=0)
+    queries = make_vectors(args.queries, args.dim, args.clusters, seed=1)
+    print(f"{args.vectors} vectors x {args.dim} dims, {args.queries} queries, recall@{args.k}\n")
+
+    # Force each type regardless of corpus size so they can be compared
+    nlist = 1 << round(np.log2(4 * np.sqrt(args.vectors)))
+    train_size = min(args.vectors, max(64 * nlist, 39 * 256))
+    # IVF is swept over the share of lists probed, which is what recall depends on
+    nprobes = sorted({max(1, nlist // share) for share in (64, 16, 8, 4, 2)})
+    candidates = [
+        ("Flat", {"factory": "IDMap2,Flat", "train_size": 0}, None, [None]),
+        ("HNSW32", {"factory": "IDMap2,HNSW32", "train_size": 0}, "efSearch", [16, 32, 64, 128, 256]),
+        (f"IVF{nlist},Flat", {"factory": f"IDMap2,IVF{nlist},Flat", "train_size": train_size}, "nprobe", nprobes),
+        (f"IVF{nlist},SQ8", {"factory": f"IDMap2,IVF{nlist},SQ8", "train_size": train_size}, "nprobe", nprobes),
+    ]
+    if args.dim % 16 == 0 and args.pq:
+        candidates.append((f"IVF{nlist},PQ{args.dim // 16}", {"factory": f"IDMap2,IVF{nlist},PQ{args.dim // 16}x8np", "train_size": train_size}, "nprobe", nprobes))
+
+    print(f"{'index':<18} {'param':>12} {'recall':>7} {'ms/query':>9} {'build s':>8} {'MB':>8}")
+    exact = None
+    for name, spec, param, values in candidates:
+        index, build_seconds = build(spec, vectors)
+        size_mb = faiss.serialize_index(index).nbytes / 2**20
+        for value in values:
+            if param:
+                apply_search_params(index, {param: value})
+            found, latency = search(index, queries, args.k)
+            if exact is None:
+                exact = found
+            label = f"{param}={value}" if param else "exact"
+            print(f"{name:<18} {label:>12} {recall_at_k(found, exact):>7.3f} {latency:>9.3f} {build_seconds:>8.1f} {size_mb:>8.1f}")
+        del index
+
+    print("\nchoose_index_spec picks:")
+    for target in (0.90, 0.95, 0.98, 0.99):
+        spec = choose_index_spec(args.vectors, args.dim, target)
+        print(f"  recall {target:.2f}: {spec['factory']} {spec['search']}")
+
+
+if __name__ == "__main__":
+    main()
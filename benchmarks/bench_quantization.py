@@ -0,0 +1,86 @@
+"""
+Measure what quantizing the stored vectors (INDEX_QUANTIZATION) costs in
+recall and saves in size and load time, for the Flat and HNSW index types.
+
+Usage:
+    python benchmarks/bench_quantization.py
+    python benchmarks/bench_quantization.py --vectors 20000 --dim 1536 --k 8
+
+Each quantizer (float32, fp16, sq8, pq) is built with the spec
+index_utils.choose_index_spec picks for the index type and recall target, on
+the synthetic clustered vectors of bench_index_recall; a quantizer the spec
+falls back from (pq below index_utils.PQ_MIN_VECTORS) is skipped. Recall@k is
+measured against exact float32 search, so it includes HNSW's own
+approximation; size is that of the index bundle as uploaded (zstd-compressed)
+and as memory-mapped, and load time is that of RAGSystem's memory-mapped read
+of the bundle file.
+"""
+import os
+import sys
+import time
+import uuid
+import argparse
+import tempfile
+
+import faiss
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from index_utils import QUANTIZERS, choose_index_spec, spec_quantization, apply_search_params, write_bundle, compress_bundle, load_bundle_file
+from bench_index_recall import make_vectors, build, recall_at_k, search
+
+
+def load(bundle_data):
+    with tempfile.NamedTemporaryFile(suffix=".bundle", delete=False) as bundle_file:
+        bundle_file.write(bundle_data)
+    try:
+        start = time.perf_counter()
+        index, _, _ = load_bundle_file(bundle_file.name)
+        return index, (time.perf_counter() - start) * 1000
+    finally:
+        os.unlink(bundle_file.name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark vector quantization recall vs size")
+    parser.add_argument("--vectors", type=int, default=20_000, help="Corpus size")
+    parser.add_argument("--dim", type=int, default=1536, help="Embedding dimension")
+    parser.add_argument("--queries", type=int, default=200, help="Number of queries")
+    parser.add_argument("--k", type=int, default=8, help="Neighbours per query")
+    parser.add_argument("--clusters", type=int, default=200, help="Cluster centres in the synthetic data")
+    parser.add_argument("--recall-target", type=float, default=0.95, help="Recall target the HNSW search parameters are chosen for")
+    args = parser.parse_args()
+
+    faiss.omp_set_num_threads(1)  # per-query latency as seen by one request
+    vectors = make_vectors(args.vectors, args.dim, args.clusters, seed=0)
+    queries = make_vectors(args.queries, args.dim, args.clusters, seed=1)
+    ids = [str(uuid.uuid4()) for _ in range(args.vectors)]
+    exact = faiss.IndexFlatL2(args.dim)
+    exact.add(vectors)
+    _, expected = exact.search(queries, args.k)
+    print(f"{args.vectors} vectors x {args.dim} dims, {args.queries} queries, recall@{args.k} vs exact float32\n")
+
+    # Force each index type regardless of corpus size so they can be compared
+    types = (("flat", {"flat_max_vectors": args.vectors}), ("hnsw", {"flat_max_vectors": 0}))
+    print(f"{'index':<28} {'recall':>7} {'ms/query':>9} {'build s':>8} {'MB':>7} {'zstd MB':>8} {'load ms':>8}")
+    for _, limits in types:
+        for quantization in QUANTIZERS:
+            spec = choose_index_spec(args.vectors, args.dim, args.recall_target, quantization=quantization, **limits)
+            if spec_quantization(spec) != quantization:
+                # e.g. pq on a corpus too small to train it, which would repeat the sq8 row
+                print(f"{spec['type'] + ' ' + quantization:<28} skipped, falls back to {spec_quantization(spec)}")
+                continue
+            index, build_seconds = build(spec, vectors)
+            bundle_data, _ = write_bundle(index, ids, {"spec": spec})
+            compressed_mb = len(compress_bundle(bundle_data)) / 2**20
+            del index
+            index, load_ms = load(bundle_data)
+            apply_search_params(index, spec["search"])
+            found, latency = search(index, queries, args.k)
+            print(f"{spec['factory']:<28} {recall_at_k(found, expected):>7.3f} {latency:>9.3f} {build_seconds:>8.1f} "
+                  f"{len(bundle_data) / 2**20:>7.1f} {compressed_mb:>8.1f} {load_ms:>8.1f}")
+            del index
+
+
+if __name__ == "__main__":
+    main()
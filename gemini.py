@@ -1,9 +1,19 @@
 import os
+import io
 import fitz  # PyMuPDF
+from PIL import Image, ImageOps
 import google.generativeai as genai
 from datetime import datetime
+import re
+import hashlib
 from dotenv import load_dotenv
 import logging
+from page_cache import PageCache, page_cache_key
+from gemini_scheduler import GeminiScheduler, GeminiRetriesExhaustedError
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -12,25 +22,247 @@ logger = logging.getLogger(__name__)
 # Load environment variables from .env
 load_dotenv()
 
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.0-flash-exp")
+
+# Maximum number of Gemini requests in flight for a single document
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", 4))
+# Maximum number of rendered pages held in memory at once while extracting
+GEMINI_MAX_RESIDENT_PAGES = int(os.getenv("GEMINI_MAX_RESIDENT_PAGES", 8))
+# Pack up to this many pages (and at most this many bytes) into a single Gemini
+# request; 1 disables batching
+GEMINI_BATCH_PAGES = int(os.getenv("GEMINI_BATCH_PAGES", 1))
+GEMINI_BATCH_BYTES = int(os.getenv("GEMINI_BATCH_BYTES", 8 * 1024 * 1024))
+
+BATCH_PROMPT = (
+    "{prompt}\n\n"
+    "The following {count} pages are each introduced by a marker line such as '--- page_1 ---'. "
+    "Handle every page separately. For each page, start your answer with its exact marker line "
+    "on its own line, followed by the result for that page only. Pages: {labels}."
+)
+
+# Born-digital PDF pages with at least this many characters in their text layer
+# skip rasterization and are sent to Gemini as plain text instead
+PDF_TEXT_LAYER_MIN_CHARS = int(os.getenv("PDF_TEXT_LAYER_MIN_CHARS", 200))
+# "summarize" sends text-layer pages to Gemini as text, "raw" stores the text
+# without calling the model, "off" always rasterizes
+PDF_TEXT_LAYER_MODE = os.getenv("PDF_TEXT_LAYER_MODE", "summarize").lower()
+
+# Worker processes used to rasterize PDF pages (0 or 1 renders in the calling thread)
+PDF_RENDER_PROCESSES = int(os.getenv("PDF_RENDER_PROCESSES", os.cpu_count() or 1))
+# Most consecutive pages rendered by one worker task (fewer when that is needed
+# to keep every process busy within GEMINI_MAX_RESIDENT_PAGES)
+PDF_RENDER_PAGES_PER_TASK = int(os.getenv("PDF_RENDER_PAGES_PER_TASK", 4))
+
+# Image preprocessing applied to every page image before it is sent to Gemini
+IMAGE_PREPROCESS = os.getenv("IMAGE_PREPROCESS", "true").lower() == "true"
+# Longest side in pixels after downscaling (0 keeps the original size)
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", 2048))
+IMAGE_GRAYSCALE = os.getenv("IMAGE_GRAYSCALE", "false").lower() == "true"
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", 80))
+IMAGE_AUTOCROP = os.getenv("IMAGE_AUTOCROP", "true").lower() == "true"
+
+# Process-wide Gemini budgets shared by every document being processed
+# (0 disables a budget), and retries for 429s, 5xx errors and timeouts
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", 60))
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", 1_000_000))
+GEMINI_MAX_IN_FLIGHT = int(os.getenv("GEMINI_MAX_IN_FLIGHT", 8))
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", 5))
+GEMINI_BACKOFF_BASE = float(os.getenv("GEMINI_BACKOFF_BASE", 1.0))
+GEMINI_BACKOFF_MAX = float(os.getenv("GEMINI_BACKOFF_MAX", 60.0))
+# Token estimates charged against the TPM budget before a request is sent;
+# corrected with the usage Gemini reports once it completes
+GEMINI_IMAGE_TOKEN_ESTIMATE = int(os.getenv("GEMINI_IMAGE_TOKEN_ESTIMATE", 1290))
+GEMINI_OUTPUT_TOKEN_ESTIMATE = int(os.getenv("GEMINI_OUTPUT_TOKEN_ESTIMATE", 512))
+
+scheduler = GeminiScheduler(
+    requests_per_minute=GEMINI_RPM,
+    tokens_per_minute=GEMINI_TPM,
+    max_in_flight=GEMINI_MAX_IN_FLIGHT,
+    max_retries=GEMINI_MAX_RETRIES,
+    backoff_base=GEMINI_BACKOFF_BASE,
+    backoff_max=GEMINI_BACKOFF_MAX
+)
+
+# Configure the client once per process
+if os.getenv("GEMINI_API_KEY"):
+    genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+model = genai.GenerativeModel(GEMINI_MODEL)
+
+# Cache of Gemini page results keyed by page content, prompt and model name.
+# Set PAGE_CACHE_DIR to an empty string to disable the disk tier.
+page_cache = PageCache(
+    cache_dir=os.getenv("PAGE_CACHE_DIR", ".cache/pages") or None,
+    max_disk_bytes=int(os.getenv("PAGE_CACHE_MAX_BYTES", 256 * 1024 * 1024)),
+    memory_items=int(os.getenv("PAGE_CACHE_MEMORY_ITEMS", 256))
+)
+
+_render_pool = None
+_render_pool_lock = threading.Lock()
+
+
+def _get_render_pool():
+    """
+    Lazily creates the process pool shared by all PDF rendering in this process.
+    """
+    global _render_pool
+    with _render_pool_lock:
+        if _render_pool is None:
+            logger.info(f"🧵 Starting PDF render pool with {PDF_RENDER_PROCESSES} processes")
+            # spawn rather than fork: the web server process is multi-threaded
+            _render_pool = ProcessPoolExecutor(
+                max_workers=PDF_RENDER_PROCESSES,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _render_pool
+
+
+def _open_pdf(source):
+    """
+    Opens a PDF from a file path or from in-memory bytes. The buffer is used
+    in place, not copied.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return fitz.open(stream=source, filetype="pdf")
+    return fitz.open(source)
+
+
+def _render_page(page, dpi, use_text_layer, preprocess=False):
+    """
+    Returns the page's text layer (str) when it is usable, otherwise its JPEG image bytes.
+    With preprocess, the rendered pixels are cropped and downscaled (see
+    preprocess_image) before the single JPEG encode.
+    """
+    if use_text_layer:
+        text = page.get_text("text").strip()
+        if len(text) >= PDF_TEXT_LAYER_MIN_CHARS:
+            return text
+    if not preprocess:
+        pix = page.get_pixmap(dpi=dpi)
+        image_bytes = pix.tobytes("jpeg")
+        # Release the raw pixmap before handing the page downstream
+        del pix
+        return image_bytes
+    pix = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY if IMAGE_GRAYSCALE else fitz.csRGB)
+    img = Image.frombytes("L" if IMAGE_GRAYSCALE else "RGB", (pix.width, pix.height), pix.samples)
+    del pix
+    return _shrink_image(img)
+
+
+def _render_page_range(source, start, stop, dpi, use_text_layer, preprocess=False):
+    """
+    Renders pages [start, stop) of a PDF. Runs inside a render pool worker process.
+    source is a file path or the name of a shared memory block holding the PDF
+    bytes, as ("shm", name, size).
+    """
+    shared = None
+    if isinstance(source, tuple):
+        _, name, size = source
+        shared = shared_memory.SharedMemory(name=name)
+        source = shared.buf[:size]
+    doc = _open_pdf(source)
+    try:
+        return [(_render_page(doc[i], dpi, use_text_layer, preprocess), f"page_{i + 1}") for i in range(start, stop)]
+    finally:
+        doc.close()
+        if shared is not None:
+            # The view must be released before the block can be closed
+            source.release()
+            shared.close()
+
+
+def iter_pages_from_pdf(pdf_path, dpi=300, use_text_layer=True, processes=None, progress_callback=None, preprocess=False):
+    """
+    Lazily yields each page of a PDF in page order. Pages with a usable text
+    layer are yielded as text (str); scanned pages are rendered into JPEG image bytes.
+    pdf_path may also be the PDF's bytes. When processes > 1, page ranges are
+    rendered in parallel by the render pool, with at most GEMINI_MAX_RESIDENT_PAGES
+    pages rendered ahead of the consumer (ranges are shortened so that window
+    spans up to `processes` ranges, one page each at the least);
+    in-memory PDFs are handed to the workers through one shared memory block
+    rather than pickled into every task.
+    With preprocess, image pages are cropped, downscaled and encoded once by
+    the renderer (see preprocess_image) instead of in a later pipeline stage.
+    progress_callback(event, **details) is called with "document_opened" (pages)
+    and "page_rendered" (label) as each page becomes available.
+    """
+    logger.info(f"📄 Streaming pages from PDF: {pdf_path if isinstance(pdf_path, str) else 'in-memory document'}")
+    use_text_layer = use_text_layer and PDF_TEXT_LAYER_MODE != "off"
+    processes = PDF_RENDER_PROCESSES if processes is None else processes
+    # Small enough ranges that the resident-page window covers every process
+    pages_per_task = max(1, min(PDF_RENDER_PAGES_PER_TASK, GEMINI_MAX_RESIDENT_PAGES // max(1, processes)))
+
+    doc = _open_pdf(pdf_path)
+    page_count = len(doc)
+    shared = None
+    text_pages = 0
+    if progress_callback:
+        progress_callback("document_opened", pages=page_count)
+    try:
+        if processes <= 1 or page_count <= pages_per_task:
+            for i, page in enumerate(doc):
+                page_data = _render_page(page, dpi, use_text_layer, preprocess)
+                text_pages += isinstance(page_data, str)
+                if progress_callback:
+                    progress_callback("page_rendered", label=f"page_{i + 1}")
+                yield (page_data, f"page_{i + 1}")
+        else:
+            # Workers open their own copy of the document
+            doc.close()
+            source = pdf_path
+            if isinstance(pdf_path, (bytes, bytearray, memoryview)):
+                size = len(pdf_path)
+                shared = shared_memory.SharedMemory(create=True, size=size)
+                shared.buf[:size] = pdf_path
+                source = ("shm", shared.name, size)
+            pool = _get_render_pool()
+            ranges = [(start, min(start + pages_per_task, page_count)) for start in range(0, page_count, pages_per_task)]
+            # Keep workers busy, but never render more pages ahead of extraction
+            # than GEMINI_MAX_RESIDENT_PAGES (and at most one queued range per worker)
+            max_outstanding = min(processes * 2, max(1, GEMINI_MAX_RESIDENT_PAGES // pages_per_task))
+            outstanding = []
+            next_range = 0
+            try:
+                while next_range < len(ranges) or outstanding:
+                    while next_range < len(ranges) and len(outstanding) < max_outstanding:
+                        start, stop = ranges[next_range]
+                        outstanding.append(pool.submit(_render_page_range, source, start, stop, dpi, use_text_layer, preprocess))
+                        next_range += 1
+                    for page_data, label in outstanding.pop(0).result():
+                        text_pages += isinstance(page_data, str)
+                        if progress_callback:
+                            progress_callback("page_rendered", label=label)
+                        yield (page_data, label)
+            finally:
+                # The consumer stopped early (error or generator closed): drop ranges not started yet
+                for future in outstanding:
+                    future.cancel()
+        logger.info(f"✅ Streamed {page_count} pages from PDF ({text_pages} from the text layer)")
+    finally:
+        if not doc.is_closed:
+            doc.close()
+        if shared is not None:
+            shared.close()
+            shared.unlink()
+
+
 def extract_images_from_pdf(pdf_path, dpi=300):
     """
     Converts each page of a PDF into JPEG image bytes.
     """
     logger.info(f"📄 Extracting images from PDF: {pdf_path}")
-    doc = fitz.open(pdf_path)
-    images = []
-    for i, page in enumerate(doc):
-        pix = page.get_pixmap(dpi=dpi)
-        image_bytes = pix.tobytes("jpeg")
-        images.append((image_bytes, f"page_{i + 1}"))
+    images = list(iter_pages_from_pdf(pdf_path, dpi=dpi, use_text_layer=False))
     logger.info(f"✅ Extracted {len(images)} pages from PDF")
     return images
 
 
-def read_image_file(image_path):
+def read_image_file(image_path, file_name=None):
     """
-    Reads a single image file and returns its bytes.
+    Reads a single image file and returns its bytes. image_path may also be the
+    image's bytes, in which case file_name labels the page.
     """
+    if isinstance(image_path, (bytes, bytearray, memoryview)):
+        logger.info(f"🖼️ Reading in-memory image: {file_name}")
+        return [(bytes(image_path), os.path.basename(file_name or "image"))]
     logger.info(f"🖼️ Reading image file: {image_path}")
     with open(image_path, "rb") as img:
         image_data = [(img.read(), os.path.basename(image_path))]
@@ -38,65 +270,402 @@ def read_image_file(image_path):
     return image_data
 
 
-def extract_text_summary_from_images(images_with_labels, prompt="Extract the text and summarize the file."):
+def preprocess_image(image_bytes, max_dimension=None, grayscale=None, jpeg_quality=None, autocrop=None):
     """
-    Uses Gemini Flash 2.0 to extract and summarize text from a list of image byte data.
+    Shrinks a page image before upload: crops blank margins, downscales to
+    max_dimension, optionally converts to grayscale and re-encodes as JPEG.
+    Settings default to the IMAGE_* environment configuration.
+    """
+    grayscale = IMAGE_GRAYSCALE if grayscale is None else grayscale
+
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        # Phone photos carry their rotation in EXIF rather than in the pixels
+        img = ImageOps.exif_transpose(img)
+        if img.mode in ("RGBA", "LA", "P"):
+            # Flatten transparency onto white so it doesn't turn black in JPEG
+            img = img.convert("RGBA")
+            img = Image.alpha_composite(Image.new("RGBA", img.size, "white"), img)
+        img = img.convert("L" if grayscale else "RGB")
+
+        return _shrink_image(img, max_dimension, jpeg_quality, autocrop)
+
+
+def _shrink_image(img, max_dimension=None, jpeg_quality=None, autocrop=None):
+    """Crops blank margins of an RGB or grayscale image, downscales it and encodes it as JPEG"""
+    max_dimension = IMAGE_MAX_DIMENSION if max_dimension is None else max_dimension
+    jpeg_quality = IMAGE_JPEG_QUALITY if jpeg_quality is None else jpeg_quality
+    autocrop = IMAGE_AUTOCROP if autocrop is None else autocrop
+
+    if autocrop:
+        # Bounding box of everything that isn't near-white, plus a small margin
+        content = img.convert("L").point(lambda p: 255 if p < 235 else 0)
+        bbox = content.getbbox()
+        if bbox:
+            margin = max(img.size) // 100
+            img = img.crop((
+                max(0, bbox[0] - margin),
+                max(0, bbox[1] - margin),
+                min(img.width, bbox[2] + margin),
+                min(img.height, bbox[3] + margin)
+            ))
+
+    if max_dimension and max(img.size) > max_dimension:
+        img.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+
+    output = io.BytesIO()
+    img.save(output, format="JPEG", quality=jpeg_quality, optimize=True)
+    return output.getvalue()
+
+
+def preprocess_pages(pages):
+    """
+    Pipeline stage that applies preprocess_image to every image page of a page
+    stream; text-layer pages pass through untouched.
+    """
+    for page_data, label in pages:
+        if isinstance(page_data, str):
+            yield (page_data, label)
+            continue
+        try:
+            processed = preprocess_image(page_data)
+            logger.info(f"🪄 Preprocessed {label}: {len(page_data)} -> {len(processed)} bytes")
+            page_data = processed
+        except Exception as e:
+            logger.warning(f"⚠️ Could not preprocess {label}, sending original: {e}")
+        yield (page_data, label)
+
+
+def _format_section(label, text):
+    return f"\n--- 📄 {label} ---\n{text}"
+
+
+def page_content_hash(page_data):
+    """
+    Hash of a page's payload (image bytes or text layer) used to detect changed pages.
+    """
+    if isinstance(page_data, str):
+        page_data = page_data.encode("utf-8")
+    return hashlib.sha256(page_data).hexdigest()
+
+
+def format_pages(pages):
+    """
+    Joins per-page results (see extract_pages) into a document summary.
+    """
+    return "\n".join(_format_section(page["label"], page["content"]) for page in pages)
+
+
+def _page_part(page_data, label):
+    """
+    Builds the generate_content part for a page: the text layer as a str, or a JPEG image part.
+    """
+    if isinstance(page_data, str):
+        # Text-only request: far fewer input tokens than the rendered image
+        return f"Text of {label}:\n{page_data}"
+    return {
+        "mime_type": "image/jpeg",
+        "data": page_data
+    }
+
+
+def _estimate_tokens(content, pages=1):
+    """
+    Rough token count of a request (about 4 characters per token, a fixed
+    estimate per image) plus the expected output for its pages.
+    """
+    tokens = GEMINI_OUTPUT_TOKEN_ESTIMATE * pages
+    for part in content:
+        tokens += len(part) // 4 if isinstance(part, str) else GEMINI_IMAGE_TOKEN_ESTIMATE
+    return tokens
+
+
+def _generate(model, content, user_id, description, pages=1):
+    """
+    Sends a generate_content request through the process-wide scheduler.
+    """
+    return scheduler.call(
+        lambda: model.generate_content(content),
+        user_id=user_id,
+        estimated_tokens=_estimate_tokens(content, pages),
+        description=description
+    )
+
+
+def _cached_result(page_data, label, prompt):
+    """
+    Returns the result for a page if it can be produced without a model call.
+    """
+    if isinstance(page_data, str) and PDF_TEXT_LAYER_MODE == "raw":
+        logger.info(f"✅ {label} taken from the PDF text layer")
+        return {"content": page_data, "error": False}
+
+    cached_text = page_cache.get(page_cache_key(page_data, prompt, GEMINI_MODEL))
+    if cached_text is not None:
+        logger.info(f"✅ {label} served from page cache")
+        return {"content": cached_text, "error": False}
+    return None
+
+
+def _extract_page(model, page_data, label, prompt, check_cache=True, user_id=None):
+    """
+    Sends a single page to Gemini and returns its result as
+    {"content": text, "error": bool}.
+    page_data is JPEG image bytes, or the page's text layer as a str.
+    Raises GeminiRetriesExhaustedError if Gemini stays rate limited or
+    unavailable, rather than recording an error in place of the page.
+    """
+    logger.info(f"📝 Processing {label}...")
+    try:
+        if check_cache:
+            result = _cached_result(page_data, label, prompt)
+            if result is not None:
+                return result
+
+        # Generate content with the page and prompt
+        response = _generate(model, [prompt, _page_part(page_data, label)], user_id, f"Gemini request for {label}")
+        response_text = response.text.strip()
+        page_cache.put(page_cache_key(page_data, prompt, GEMINI_MODEL), response_text)
+
+        logger.info(f"✅ {label} processed successfully")
+        return {"content": response_text, "error": False}
+    except GeminiRetriesExhaustedError:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Error processing {label}: {e}")
+        return {"content": f"Error processing this page: {str(e)}", "error": True}
+
+
+def _split_batch_response(response_text, labels):
+    """
+    Splits a batched response back into per-page text using its '--- page_N ---' markers.
+    Returns a dict of label -> text for every marker found.
+    """
+    marker = re.compile(
+        r"^[\s*#]*-{3,}\s*(?:📄\s*)?(" + "|".join(re.escape(label) for label in labels) + r")\s*-{3,}[\s*]*$",
+        re.MULTILINE
+    )
+    matches = list(marker.finditer(response_text))
+    sections = {}
+    for i, match in enumerate(matches):
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(response_text)
+        text = response_text[match.end():end].strip()
+        if text:
+            sections[match.group(1)] = text
+    return sections
+
+
+def _extract_batch(model, pages, prompt, user_id=None):
     """
-    api_key = os.getenv("GEMINI_API_KEY")
-    if not api_key:
+    Sends several (page_data, label) pages to Gemini in one request and returns
+    their results in input order. Pages missing from the batched response fall
+    back to single-page calls.
+    """
+    if len(pages) == 1:
+        page_data, label = pages[0]
+        return [_extract_page(model, page_data, label, prompt, user_id=user_id)]
+
+    results = {}
+    uncached = []
+    for page_data, label in pages:
+        result = _cached_result(page_data, label, prompt)
+        if result is not None:
+            results[label] = result
+        else:
+            uncached.append((page_data, label))
+
+    if len(uncached) > 1:
+        labels = [label for _, label in uncached]
+        logger.info(f"📝 Processing batch {labels[0]}..{labels[-1]} ({len(labels)} pages)...")
+        try:
+            content = [BATCH_PROMPT.format(prompt=prompt, count=len(labels), labels=", ".join(labels))]
+            for page_data, label in uncached:
+                content.append(f"--- {label} ---")
+                content.append(_page_part(page_data, label))
+
+            response = _generate(model, content, user_id, f"Gemini request for {labels[0]}..{labels[-1]}", pages=len(labels))
+            parsed = _split_batch_response(response.text, labels)
+            for page_data, label in uncached:
+                if label in parsed:
+                    page_cache.put(page_cache_key(page_data, prompt, GEMINI_MODEL), parsed[label])
+                    results[label] = {"content": parsed[label], "error": False}
+            logger.info(f"✅ Batch returned {len(parsed)}/{len(labels)} pages")
+        except GeminiRetriesExhaustedError:
+            raise
+        except Exception as e:
+            logger.warning(f"⚠️ Batched request failed, falling back to single pages: {e}")
+
+    for page_data, label in uncached:
+        if label not in results:
+            results[label] = _extract_page(model, page_data, label, prompt, check_cache=False, user_id=user_id)
+
+    return [results[label] for _, label in pages]
+
+
+def _iter_batches(pages, batch_pages, batch_bytes):
+    """
+    Groups a stream of page dicts into batches of at most batch_pages pages and batch_bytes bytes.
+    """
+    batch = []
+    size = 0
+    for page in pages:
+        page_data = page["data"]
+        page_size = len(page_data.encode("utf-8")) if isinstance(page_data, str) else len(page_data)
+        if batch and (len(batch) >= batch_pages or size + page_size > batch_bytes):
+            yield batch
+            batch = []
+            size = 0
+        batch.append(page)
+        size += page_size
+    if batch:
+        yield batch
+
+
+def extract_pages(images_with_labels, prompt="Extract the text and summarize the file.", max_concurrency=None, max_resident_pages=None, batch_pages=None, batch_bytes=None, progress_callback=None, known_pages=None, user_id=None):
+    """
+    Uses Gemini Flash 2.0 to extract and summarize text from image byte data
+    (or from text-layer pages, which are passed through as str) and returns one
+    dict per page, in page order:
+    {"page_number", "label", "page_hash", "content", "error", "reused"}.
+
+    images_with_labels may be a list or a lazy iterator (see iter_pages_from_pdf);
+    pages are pulled only while fewer than max_resident_pages are waiting on Gemini,
+    at most max_concurrency requests are in flight. With batch_pages > 1, consecutive
+    pages are packed into a single request (bounded by batch_bytes).
+    known_pages maps page_hash -> previously extracted content; matching pages are
+    reused without a model call.
+    progress_callback(event, **details) is called with "page_extracted" (label, section)
+    as each page completes.
+    Model calls go through the process-wide scheduler, which queues them fairly
+    per user_id and retries rate-limited or failed requests.
+    """
+    if not os.getenv("GEMINI_API_KEY"):
         logger.error("❌ GEMINI_API_KEY not found in environment variables")
         raise EnvironmentError("GEMINI_API_KEY not found in environment variables.")
 
-    logger.info("🤖 Initializing Gemini client...")
-    genai.configure(api_key=api_key)
-    model = genai.GenerativeModel('gemini-2.0-flash-exp')
+    max_concurrency = max(1, max_concurrency or GEMINI_MAX_CONCURRENCY)
+    batch_pages = max(1, batch_pages or GEMINI_BATCH_PAGES)
+    batch_bytes = batch_bytes or GEMINI_BATCH_BYTES
+    max_resident_pages = max(max_concurrency, batch_pages, max_resident_pages or GEMINI_MAX_RESIDENT_PAGES)
+    known_pages = known_pages or {}
+    logger.info(f"🔄 Processing images with Gemini ({max_concurrency} concurrent, {max_resident_pages} resident, {batch_pages} per request)...")
 
-    all_results = []
-    logger.info(f"🔄 Processing {len(images_with_labels)} images with Gemini...")
+    results = {}
+    pending = {}
 
-    for i, (image_bytes, label) in enumerate(images_with_labels):
-        logger.info(f"📝 Processing {label} ({i+1}/{len(images_with_labels)})...")
-        
+    def finish(page, result, reused=False):
+        results[page["index"]] = {
+            "page_number": page["index"] + 1,
+            "label": page["label"],
+            "page_hash": page["page_hash"],
+            "content": result["content"],
+            "error": result["error"],
+            "reused": reused
+        }
+        if progress_callback:
+            progress_callback("page_extracted", label=page["label"], section=_format_section(page["label"], result["content"]))
+
+    def collect(done):
+        for future in done:
+            batch = pending.pop(future)
+            for page, result in zip(batch, future.result()):
+                finish(page, result)
+
+    def resident_pages():
+        return sum(len(batch) for batch in pending.values())
+
+    def changed_pages():
+        # Pages whose hash matches a stored result never reach the model
+        for index, (page_data, label) in enumerate(images_with_labels):
+            page = {"index": index, "data": page_data, "label": label, "page_hash": page_content_hash(page_data)}
+            if page["page_hash"] in known_pages:
+                logger.info(f"♻️ {label} unchanged, reusing stored result")
+                finish(page, {"content": known_pages[page["page_hash"]], "error": False}, reused=True)
+                continue
+            yield page
+
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
         try:
-            # Create image part
-            image_part = {
-                "mime_type": "image/jpeg",
-                "data": image_bytes
-            }
-            
-            # Generate content with image and prompt
-            response = model.generate_content([prompt, image_part])
-            response_text = response.text
-            
-            all_results.append(f"\n--- 📄 {label} ---\n{response_text.strip()}")
-            logger.info(f"✅ {label} processed successfully")
-        except Exception as e:
-            logger.error(f"❌ Error processing {label}: {e}")
-            all_results.append(f"\n--- 📄 {label} ---\nError processing this page: {str(e)}")
+            for batch in _iter_batches(changed_pages(), batch_pages, batch_bytes):
+                # Back-pressure: don't render further pages until resident slots free up
+                while pending and resident_pages() + len(batch) > max_resident_pages:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+                future = executor.submit(_extract_batch, model, [(page["data"], page["label"]) for page in batch], prompt, user_id)
+                # Keep only metadata for pending pages so the bytes are freed once sent
+                pending[future] = [{key: value for key, value in page.items() if key != "data"} for page in batch]
+                del batch
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+        except Exception:
+            # Don't spend the shared rate budget on a document that has already failed
+            for future in pending:
+                future.cancel()
+            raise
 
-    final_result = "\n".join(all_results)
-    logger.info(f"✅ All images processed. Total summary length: {len(final_result)} characters")
+    pages = [results[index] for index in sorted(results)]
+    reused = sum(page["reused"] for page in pages)
+    logger.info(f"✅ All {len(pages)} images processed ({reused} reused unchanged)")
+    logger.info(f"🗄️ Page cache stats: {page_cache.stats()}")
+    logger.info(f"🚦 Gemini scheduler stats: {scheduler.stats()}")
+    return pages
+
+
+def extract_text_summary_from_images(images_with_labels, prompt="Extract the text and summarize the file.", **kwargs):
+    """
+    Uses Gemini Flash 2.0 to extract and summarize text from a list of image byte data.
+    Accepts the same options as extract_pages and returns the joined summary.
+    """
+    final_result = format_pages(extract_pages(images_with_labels, prompt, **kwargs))
+    logger.info(f"✅ Total summary length: {len(final_result)} characters")
     return final_result
 
 
-def process_file(file_path):
-    logger.info(f"🚀 Starting file processing: {file_path}")
-    ext = os.path.splitext(file_path)[1].lower()
+def _iter_document_pages(file_path, progress_callback=None, file_name=None):
+    ext = os.path.splitext(file_name or file_path)[1].lower()
     
     if ext == ".pdf":
         logger.info("📄 Processing PDF file...")
-        images = extract_images_from_pdf(file_path)
+        # Rendered pages are preprocessed by the renderer itself
+        images = iter_pages_from_pdf(file_path, progress_callback=progress_callback, preprocess=IMAGE_PREPROCESS)
     elif ext in [".jpg", ".jpeg", ".png"]:
         logger.info("🖼️ Processing image file...")
-        images = read_image_file(file_path)
+        images = read_image_file(file_path, file_name)
+        if progress_callback:
+            progress_callback("document_opened", pages=1)
+            progress_callback("page_rendered", label=images[0][1])
+        if IMAGE_PREPROCESS:
+            images = preprocess_pages(images)
     else:
         logger.error(f"❌ Unsupported file type: {ext}")
         raise ValueError("Unsupported file type. Use PDF or image.")
     
+    return images
+
+
+def process_file_pages(file_path, progress_callback=None, known_pages=None, file_name=None, user_id=None):
+    """
+    Extracts a PDF or image file page by page and returns the per-page results
+    (see extract_pages). Pages whose hash is in known_pages are not re-extracted.
+    file_path may also be the file's bytes, with file_name giving its extension,
+    so uploads are processed straight from memory.
+    """
+    logger.info(f"🚀 Starting file processing: {file_name or file_path}")
+    images = _iter_document_pages(file_path, progress_callback, file_name)
+    
     logger.info("🤖 Starting AI text extraction...")
-    summary = extract_text_summary_from_images(images)
+    pages = extract_pages(images, progress_callback=progress_callback, known_pages=known_pages, user_id=user_id)
     logger.info("✅ File processing completed successfully")
-    return summary
+    return pages
+
+
+def process_file(file_path, progress_callback=None):
+    """
+    Extracts and summarizes a PDF or image file. progress_callback(event, **details)
+    receives "document_opened", "page_rendered" and "page_extracted" events as
+    processing advances.
+    """
+    return format_pages(process_file_pages(file_path, progress_callback))
 
 def save_summary_to_supabase(summary_text, source_file, user_id=None, supabase_client=None, storage_path=None):
     """
@@ -137,6 +706,113 @@ def save_summary_to_supabase(summary_text, source_file, user_id=None, supabase_c
         logger.error(f"❌ Error saving to Supabase: {e}")
         raise Exception(f"Failed to save document to Supabase: {str(e)}")
 
+def save_summaries_to_supabase(documents, supabase_client=None):
+    """
+    Saves several documents in a single batched insert. Each item is a dict with
+    summary_text, source_file, user_id and storage_path. Returns the new document
+    ids in input order.
+    """
+    if not supabase_client:
+        logger.error("❌ Supabase client not provided")
+        raise ValueError("Supabase client is required")
+    if not documents:
+        return []
+    
+    logger.info(f"💾 Saving {len(documents)} documents to Supabase in one insert")
+    try:
+        timestamp = datetime.utcnow().isoformat()
+        rows = [
+            {
+                "user_id": doc["user_id"],
+                "file_name": os.path.basename(doc["source_file"]),
+                "summary": doc["summary_text"],
+                "source_path": doc.get("storage_path") or doc["source_file"],
+                "timestamp": timestamp
+            }
+            for doc in documents
+        ]
+        response = supabase_client.table('documents').insert(rows).execute()
+        
+        if not response.data or len(response.data) != len(rows):
+            logger.error("❌ Supabase batch insert returned an unexpected number of rows")
+            raise Exception("Failed to save documents to Supabase")
+        
+        document_ids = [row['id'] for row in response.data]
+        logger.info(f"✅ Saved {len(document_ids)} documents")
+        return document_ids
+    
+    except Exception as e:
+        logger.error(f"❌ Error saving documents to Supabase: {e}")
+        raise Exception(f"Failed to save documents to Supabase: {str(e)}")
+
+def save_pages_to_supabase(document_id, pages, user_id=None, supabase_client=None):
+    """
+    Persists per-page extraction results (see extract_pages) into the document_pages
+    table, replacing the document's previous pages. Pages that failed extraction are
+    stored without a hash so they are always retried on the next reprocess.
+    """
+    if not supabase_client:
+        logger.error("❌ Supabase client not provided")
+        raise ValueError("Supabase client is required")
+    
+    logger.info(f"💾 Saving {len(pages)} pages for document {document_id}")
+    try:
+        rows = [
+            {
+                "document_id": document_id,
+                "user_id": user_id,
+                "page_number": page["page_number"],
+                "page_label": page["label"],
+                "page_hash": None if page["error"] else page["page_hash"],
+                "content": page["content"]
+            }
+            for page in pages
+        ]
+        if rows:
+            supabase_client.table('document_pages').upsert(rows, on_conflict="document_id,page_number").execute()
+        # Drop pages beyond the end of a revised, shorter document
+        supabase_client.table('document_pages').delete().eq('document_id', document_id).gt('page_number', len(pages)).execute()
+        logger.info(f"✅ Pages saved for document {document_id}")
+    except Exception as e:
+        logger.error(f"❌ Error saving pages to Supabase: {e}")
+        raise Exception(f"Failed to save pages to Supabase: {str(e)}")
+
+def load_known_pages(document_id, supabase_client=None):
+    """
+    Returns {page_hash: content} for a document's stored pages, for use as
+    extract_pages(known_pages=...).
+    """
+    if not supabase_client:
+        logger.error("❌ Supabase client not provided")
+        raise ValueError("Supabase client is required")
+    
+    response = supabase_client.table('document_pages').select('page_hash, content').eq('document_id', document_id).execute()
+    known_pages = {row['page_hash']: row['content'] for row in response.data if row.get('page_hash')}
+    logger.info(f"📄 Loaded {len(known_pages)} stored page hashes for document {document_id}")
+    return known_pages
+
+def update_summary_in_supabase(document_id, summary_text, supabase_client=None):
+    """
+    Replaces a document's summary after reprocessing and clears its embedding so
+    the next indexing run re-embeds it.
+    """
+    if not supabase_client:
+        logger.error("❌ Supabase client not provided")
+        raise ValueError("Supabase client is required")
+    
+    logger.info(f"💾 Updating summary for document {document_id} ({len(summary_text)} characters)")
+    try:
+        supabase_client.table('documents').update({
+            "summary": summary_text,
+            "embedding": None,
+            "indexed_at": None,
+            "timestamp": datetime.utcnow().isoformat()
+        }).eq('id', document_id).execute()
+        logger.info(f"✅ Summary updated for document {document_id}")
+    except Exception as e:
+        logger.error(f"❌ Error updating summary in Supabase: {e}")
+        raise Exception(f"Failed to update summary in Supabase: {str(e)}")
+
 if __name__ == "__main__":
     # 🧪 Example: Replace this with your actual file
     #file_path = r"C:\Users\umesh\Downloads\WhatsApp Image 2025-05-27 at 9.17.44 PM.jpeg"# or "sample_image.jpg"
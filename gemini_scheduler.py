@@ -0,0 +1,213 @@
+import time
+import random
+import logging
+import threading
+from collections import OrderedDict, deque
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# HTTP status codes worth retrying: rate limited, server errors and timeouts
+RETRYABLE_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+RETRYABLE_MESSAGES = ("resource has been exhausted", "rate limit", "quota", "timed out", "temporarily unavailable")
+
+
+class GeminiRetriesExhaustedError(Exception):
+    """Raised when a model call still fails with a retryable error after every retry."""
+
+
+def is_retryable(error):
+    """
+    True for rate limiting (429), transient server errors and timeouts.
+    google.api_core exceptions carry the HTTP status in .code.
+    """
+    code = getattr(error, "code", None)
+    if isinstance(code, int) and code in RETRYABLE_STATUS_CODES:
+        return True
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+    message = str(error).lower()
+    return "429" in message or any(text in message for text in RETRYABLE_MESSAGES)
+
+
+def _is_rate_limited(error):
+    return getattr(error, "code", None) == 429 or "429" in str(error) or "exhausted" in str(error).lower()
+
+
+def usage_tokens(response):
+    """Total tokens reported for a generate_content response, or None if not reported."""
+    usage = getattr(response, "usage_metadata", None)
+    total = getattr(usage, "total_token_count", None)
+    return total if isinstance(total, int) and total > 0 else None
+
+
+class TokenBucket:
+    """
+    Budget of per_minute units that refills continuously. A per_minute of 0
+    means unlimited.
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.level = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Seconds until amount units are available (0 if they are available now)."""
+        if self.capacity <= 0:
+            return 0.0
+        self._refill()
+        # A request larger than the whole budget only waits for a full bucket
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount):
+        """Consume amount units; a negative amount returns units to the bucket."""
+        if self.capacity <= 0:
+            return
+        self._refill()
+        self.level = min(self.capacity, self.level - min(amount, self.capacity))
+
+
+class GeminiScheduler:
+    """
+    Process-wide scheduler for Gemini calls.
+
+    - Requests-per-minute and tokens-per-minute budgets (token buckets) shared by
+      every document being processed; token estimates are corrected with the
+      usage reported in each response
+    - At most max_in_flight calls running at once
+    - Fair queuing: waiting calls are granted round-robin across users, so one
+      large upload cannot starve everyone else
+    - Retryable errors (429, 5xx, timeouts) are retried with jittered exponential
+      backoff; a 429 also pauses all dispatching for the backoff period
+    """
+
+    def __init__(self, requests_per_minute=60, tokens_per_minute=1_000_000, max_in_flight=8,
+                 max_retries=5, backoff_base=1.0, backoff_max=60.0):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._cond = threading.Condition()
+        # user_id -> waiting tickets; dict order is the round-robin rotation
+        self._queues = OrderedDict()
+        self._in_flight = 0
+        self._paused_until = 0.0
+        self._dispatcher = None
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+
+    def _ensure_dispatcher(self):
+        # Started on first use so processes that never call Gemini (e.g. render workers) don't run it
+        if self._dispatcher is None:
+            self._dispatcher = threading.Thread(target=self._dispatch, name="gemini-scheduler", daemon=True)
+            self._dispatcher.start()
+
+    def _dispatch(self):
+        with self._cond:
+            while True:
+                if not self._queues or self._in_flight >= self.max_in_flight:
+                    self._cond.wait()
+                    continue
+                user_id, queue = next(iter(self._queues.items()))
+                ticket = queue[0]
+                delay = max(
+                    self._paused_until - time.monotonic(),
+                    self.requests.wait_time(1),
+                    self.tokens.wait_time(ticket["tokens"])
+                )
+                if delay > 0:
+                    self._cond.wait(timeout=delay)
+                    continue
+                self.requests.take(1)
+                self.tokens.take(ticket["tokens"])
+                queue.popleft()
+                ticket["granted"] = True
+                self._in_flight += 1
+                # Move this user to the back of the rotation
+                if queue:
+                    self._queues.move_to_end(user_id)
+                else:
+                    del self._queues[user_id]
+                self._cond.notify_all()
+
+    def _acquire(self, user_id, estimated_tokens):
+        ticket = {"tokens": estimated_tokens, "granted": False}
+        with self._cond:
+            self._ensure_dispatcher()
+            self._queues.setdefault(user_id, deque()).append(ticket)
+            self._cond.notify_all()
+            while not ticket["granted"]:
+                self._cond.wait()
+
+    def _release(self, estimated_tokens, used_tokens):
+        with self._cond:
+            self._in_flight -= 1
+            if used_tokens is not None:
+                self.tokens.take(used_tokens - estimated_tokens)
+            self._cond.notify_all()
+
+    def _backoff(self, attempt, error):
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        # Jitter so workers that failed together don't retry together
+        delay = random.uniform(delay / 2, delay)
+        if _is_rate_limited(error):
+            with self._cond:
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                self._cond.notify_all()
+        return delay
+
+    def call(self, fn, user_id=None, estimated_tokens=0, description="Gemini request"):
+        """
+        Runs fn() once the user's turn comes up and the budgets allow it, and
+        returns its result. Raises GeminiRetriesExhaustedError if a retryable
+        error persists through max_retries retries; other errors are raised as is.
+        """
+        user_id = user_id or "anonymous"
+        for attempt in range(self.max_retries + 1):
+            self._acquire(user_id, estimated_tokens)
+            used_tokens = None
+            try:
+                response = fn()
+                used_tokens = usage_tokens(response)
+                with self._cond:
+                    self.calls += 1
+                return response
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                if attempt == self.max_retries:
+                    with self._cond:
+                        self.failures += 1
+                    logger.error(f"❌ {description} failed after {self.max_retries} retries: {e}")
+                    raise GeminiRetriesExhaustedError(f"{description} failed after {self.max_retries} retries: {e}") from e
+                delay = self._backoff(attempt, e)
+                with self._cond:
+                    self.retries += 1
+                logger.warning(f"⚠️ {description} failed ({e}), retrying in {delay:.1f}s")
+            finally:
+                self._release(estimated_tokens, used_tokens)
+            time.sleep(delay)
+
+    def stats(self):
+        """Call, retry and failure counters plus current queue depth."""
+        with self._cond:
+            return {
+                "calls": self.calls,
+                "retries": self.retries,
+                "failures": self.failures,
+                "in_flight": self._in_flight,
+                "waiting": sum(len(queue) for queue in self._queues.values()),
+                "waiting_users": len(self._queues)
+            }
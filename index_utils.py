@@ -0,0 +1,379 @@
+import io
+import re
+import json
+import math
+import time
+import uuid
+import zlib
+import struct
+import logging
+import faiss
+import zstandard
+import numpy as np
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Page section markers written into summaries by gemini._format_section, e.g. '--- 📄 page_3 ---'
+SECTION_MARKER = re.compile(r"^-{3,}\s*(?:📄\s*)?(.+?)\s*-{3,}\s*$", re.MULTILINE)
+
+
+def parse_vector(embedding_data, dim=None):
+    """
+    Parse one embedding into a float32 array. pgvector columns come back as
+    '[x,y,...]' strings, which are parsed by numpy's C number parser rather than
+    evaluated as Python literals; lists are converted directly. Raises ValueError
+    for malformed data or a length other than dim (when given).
+    """
+    if isinstance(embedding_data, str):
+        text = embedding_data.strip()
+        if not (text.startswith("[") and text.endswith("]")):
+            raise ValueError("not a vector literal")
+        vector = np.fromstring(text[1:-1], sep=",", dtype=np.float32)
+    elif isinstance(embedding_data, (list, tuple, np.ndarray)):
+        vector = np.asarray(embedding_data, dtype=np.float32)
+    else:
+        raise ValueError(f"unknown embedding data type {type(embedding_data).__name__}")
+    if vector.ndim != 1 or not vector.size or (dim is not None and vector.size != dim):
+        raise ValueError(f"expected {dim or 'a non-empty'} dimensional vector, got shape {vector.shape}")
+    return vector
+
+
+def decode_embeddings(documents, id_key="id", embedding_key="embedding"):
+    """
+    Decode the embeddings of documents in a single pass into a preallocated
+    float32 matrix. Returns (ids, matrix) where ids[i] is the string id of
+    matrix row i; documents whose embedding is missing, malformed or of a
+    different dimension than the first one are logged and skipped.
+    """
+    documents = documents if isinstance(documents, list) else list(documents)
+    ids = []
+    matrix = None
+    skipped = 0
+    for doc in documents:
+        try:
+            if matrix is None:
+                vector = parse_vector(doc[embedding_key])
+                matrix = np.empty((len(documents), vector.size), dtype=np.float32)
+                matrix[0] = vector
+            else:
+                matrix[len(ids)] = parse_vector(doc[embedding_key], matrix.shape[1])
+        except (ValueError, TypeError) as e:
+            skipped += 1
+            logger.error(f"❌ Invalid embedding for document {doc.get(id_key)}: {e}")
+            continue
+        ids.append(str(doc[id_key]))
+    if skipped:
+        logger.warning(f"⚠️ Skipped {skipped} documents with invalid embeddings")
+    if matrix is None:
+        return ids, np.empty((0, 0), dtype=np.float32)
+    # Drop the rows reserved for skipped documents without copying
+    return ids, matrix[:len(ids)]
+
+
+def _split_text(text, max_chars):
+    """Split text into pieces of at most max_chars, cutting at a paragraph, line or word boundary where possible."""
+    pieces = []
+    while len(text) > max_chars:
+        window = text[:max_chars]
+        for separator in ("\n\n", "\n", " "):
+            cut = window.rfind(separator)
+            if cut > max_chars // 2:
+                break
+        else:
+            cut = max_chars
+        pieces.append(text[:cut].strip())
+        text = text[cut:].strip()
+    if text:
+        pieces.append(text)
+    return pieces
+
+
+def chunk_summary(summary, max_chars):
+    """
+    Split a document summary into (page_label, text) chunks: one per page
+    section ('--- page_N ---' markers), with sections longer than max_chars
+    split further. Text before the first marker (or a summary without markers)
+    gets a page_label of None.
+    """
+    markers = list(SECTION_MARKER.finditer(summary))
+    sections = [(None, summary[:markers[0].start()] if markers else summary)]
+    for number, marker in enumerate(markers):
+        end = markers[number + 1].start() if number + 1 < len(markers) else len(summary)
+        sections.append((marker.group(1), summary[marker.end():end]))
+
+    chunks = []
+    for label, text in sections:
+        chunks.extend((label, piece) for piece in _split_text(text.strip(), max_chars))
+    return chunks
+
+
+# (measured recall@8, setting) pairs from benchmarks/bench_index_recall.py on
+# 20k clustered 1536-dim vectors; the first setting that reached the target
+# recall is used. IVF is tuned as the share of lists probed.
+HNSW_EF_SEARCH = [(0.907, 64), (0.966, 128), (0.993, 256), (1.0, 512)]
+IVF_PROBE_SHARE = [(0.896, 1 / 8), (0.953, 1 / 4), (0.988, 1 / 2), (1.0, 1.0)]
+HNSW_M = 32
+
+# Codes the indexes store per vector (INDEX_QUANTIZATION): the float32 vector
+# itself, half precision (2x smaller), 8-bit scalar quantization (4x smaller)
+# or product quantization with one byte per PQ_DIMS_PER_CODE dimensions (16x)
+QUANTIZERS = ("float32", "fp16", "sq8", "pq")
+PQ_DIMS_PER_CODE = 4
+# FAISS wants 39 training points per centroid, 256 centroids per PQ code byte;
+# smaller corpora use sq8 instead
+PQ_MIN_VECTORS = 39 * 256
+# Training the scalar quantizer only needs per-dimension ranges
+SQ_TRAIN_SIZE = 10_000
+
+
+def _codec(quantization, dim):
+    # "np" skips polysemous training, which takes minutes and only serves Hamming-filtered search
+    return {"float32": "Flat", "fp16": "SQfp16", "sq8": "SQ8", "pq": f"PQ{dim // PQ_DIMS_PER_CODE}x8np"}[quantization]
+
+
+def _for_target(table, recall_target):
+    for recall, value in table:
+        if recall >= recall_target:
+            return value
+    return table[-1][1]
+
+
+def choose_index_spec(count, dim, recall_target=0.95, flat_max_vectors=20_000, ivf_min_vectors=500_000, quantization=None):
+    """
+    Pick the FAISS index for a corpus of count vectors of dimension dim:
+
+    - Flat (exact) up to flat_max_vectors, where brute force is fast enough
+    - HNSW above that, with efSearch set from recall_target
+    - IVF from ivf_min_vectors on, where HNSW's graph plus full vectors get
+      too big; nprobe is set from recall_target
+
+    quantization (one of QUANTIZERS) sets how vectors are stored; by default
+    float32 for Flat and HNSW and sq8 for IVF. pq falls back to sq8 below
+    PQ_MIN_VECTORS, and needs a dimension divisible by PQ_DIMS_PER_CODE.
+
+    Returns a spec dict: type, quantization, factory (index_factory string,
+    always ID-mapped), train_size (vectors needed before adding, 0 if no
+    training), search (search-time parameters), count and recall_target.
+    """
+    if quantization is not None and quantization not in QUANTIZERS:
+        raise ValueError(f"unknown quantization {quantization!r}, expected one of {', '.join(QUANTIZERS)}")
+    if quantization == "pq" and (count < PQ_MIN_VECTORS or dim % PQ_DIMS_PER_CODE):
+        quantization = "sq8"
+
+    spec = {"count": count, "recall_target": recall_target, "train_size": 0, "search": {}}
+    if count <= flat_max_vectors:
+        quantization = quantization or "float32"
+        spec.update(type="flat", factory=f"IDMap2,{_codec(quantization, dim)}")
+    elif count < ivf_min_vectors:
+        quantization = quantization or "float32"
+        codec = "" if quantization == "float32" else f",{_codec(quantization, dim)}"
+        spec.update(type="hnsw", factory=f"IDMap2,HNSW{HNSW_M}{codec}")
+        spec["search"] = {"efSearch": _for_target(HNSW_EF_SEARCH, recall_target)}
+    else:
+        quantization = quantization or "sq8"
+        # About 4*sqrt(n) lists, with at least 39 training points per list
+        nlist = min(1 << round(math.log2(4 * math.sqrt(count))), max(1, count // 39))
+        spec.update(type="ivf", factory=f"IDMap2,IVF{nlist},{_codec(quantization, dim)}")
+        spec["train_size"] = min(count, 64 * nlist)
+        spec["search"] = {"nprobe": max(1, math.ceil(nlist * _for_target(IVF_PROBE_SHARE, recall_target)))}
+
+    spec["quantization"] = quantization
+    if quantization == "sq8":
+        spec["train_size"] = max(spec["train_size"], min(count, SQ_TRAIN_SIZE))
+    elif quantization == "pq":
+        spec["train_size"] = max(spec["train_size"], min(count, PQ_MIN_VECTORS))
+    return spec
+
+
+def spec_quantization(spec):
+    """Quantization of an index spec; specs stored before quantization was configurable have none"""
+    return spec.get("quantization") or ("sq8" if spec["type"] == "ivf" else "float32")
+
+
+def removed_positions(ids):
+    """Positions of removed entries (None) in an id map, a list or PackedIds"""
+    if isinstance(ids, PackedIds):
+        return ids.removed().astype("int64")
+    return np.array([position for position, chunk_id in enumerate(ids) if chunk_id is None], dtype="int64")
+
+
+def exclusion_params(spec, ids):
+    """
+    Search parameters that skip the vectors of removed id map entries, or None
+    if there are none in the index. Only HNSW keeps such vectors (they can't be
+    removed from its graph); other index types drop them on removal.
+    """
+    removed = removed_positions(ids) if spec and spec.get("type") == "hnsw" else []
+    if not len(removed):
+        return None
+    batch = faiss.IDSelectorBatch(removed)
+    selector = faiss.IDSelectorNot(batch)
+    params = faiss.SearchParameters(sel=selector)
+    # The selectors must outlive the parameters that point to them
+    params.referenced_objects = [batch, selector]
+    return params
+
+
+def create_index(spec, dim):
+    """Create an empty index for spec; its FAISS ids are positions in the id map."""
+    return faiss.index_factory(dim, spec["factory"], faiss.METRIC_L2)
+
+
+def apply_search_params(index, params):
+    """Set search-time parameters (efSearch for HNSW, nprobe for IVF) on a loaded index."""
+    space = faiss.ParameterSpace()
+    for name, value in (params or {}).items():
+        space.set_index_parameter(index, name, value)
+
+
+# Index bundle layout: [FAISS index][id map: 16-byte UUIDs, all zero for removed
+# entries][manifest JSON][footer]. The FAISS index comes first so the file can be
+# passed to faiss.read_index as is; the footer locates everything else.
+BUNDLE_MAGIC = b"DHIX"
+BUNDLE_FORMAT_VERSION = 1
+BUNDLE_FOOTER = struct.Struct("<Q I 4s")  # manifest length, format version, magic
+ID_BYTES = 16
+
+# Published bundles are zstd-compressed objects named after their index version;
+# the pointer object names the current one and is only replaced once it is uploaded
+INDEX_POINTER_FILENAME = "index.json"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+class PackedIds:
+    """
+    Read-only id map over packed 16-byte UUIDs (e.g. a memory-mapped bundle):
+    ids[i] is the UUID string at position i, or None for a removed entry.
+    Strings are only created for the positions that are looked up.
+    """
+
+    def __init__(self, packed):
+        self._packed = np.asarray(packed, dtype=np.uint8).reshape(-1, ID_BYTES)
+
+    def __len__(self):
+        return len(self._packed)
+
+    def __getitem__(self, position):
+        row = self._packed[position]
+        if not row.any():
+            return None
+        return str(uuid.UUID(bytes=row.tobytes()))
+
+    def removed(self):
+        """Positions of removed entries"""
+        return np.flatnonzero(~self._packed.any(axis=1))
+
+
+def pack_ids(ids):
+    """Pack an id map of UUID strings (None for removed entries) into 16 bytes per id"""
+    empty = bytes(ID_BYTES)
+    return b"".join(empty if chunk_id is None else uuid.UUID(chunk_id).bytes for chunk_id in ids)
+
+
+def write_bundle(index, ids, manifest):
+    """
+    Serialize index and its id map into one bundle. manifest (embedding_model,
+    spec, ...) is completed with the format and index version, dimension, counts,
+    build time and the layout. Returns (bundle bytes, manifest).
+    """
+    index_data = faiss.serialize_index(index).tobytes()
+    packed = pack_ids(ids)
+    manifest = dict(
+        manifest,
+        format_version=BUNDLE_FORMAT_VERSION,
+        index_version=uuid.uuid4().hex,
+        dim=index.d,
+        count=len(ids),
+        vectors=index.ntotal,
+        built_at=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        index_bytes=len(index_data),
+        ids_crc32=zlib.crc32(packed),
+    )
+    manifest_data = json.dumps(manifest).encode()
+    footer = BUNDLE_FOOTER.pack(len(manifest_data), BUNDLE_FORMAT_VERSION, BUNDLE_MAGIC)
+    return b"".join((index_data, packed, manifest_data, footer)), manifest
+
+
+def read_bundle_layout(data):
+    """
+    Parse and check the manifest of a bundle (bytes or a memory map). Returns
+    (manifest, slice of the packed ids); raises ValueError if data is not a
+    complete bundle of a supported format or its id map is corrupt.
+    """
+    if len(data) < BUNDLE_FOOTER.size:
+        raise ValueError("too short for an index bundle")
+    manifest_length, format_version, magic = BUNDLE_FOOTER.unpack(data[-BUNDLE_FOOTER.size:])
+    if magic != BUNDLE_MAGIC:
+        raise ValueError("not an index bundle")
+    if format_version > BUNDLE_FORMAT_VERSION:
+        raise ValueError(f"bundle format {format_version} is newer than supported ({BUNDLE_FORMAT_VERSION})")
+    manifest_start = len(data) - BUNDLE_FOOTER.size - manifest_length
+    try:
+        manifest = json.loads(bytes(data[manifest_start:len(data) - BUNDLE_FOOTER.size]))
+        ids = slice(manifest["index_bytes"], manifest["index_bytes"] + manifest["count"] * ID_BYTES)
+        ids_crc32 = manifest["ids_crc32"]
+    except (ValueError, KeyError, TypeError) as e:
+        raise ValueError(f"unreadable bundle manifest: {e}")
+    if ids.stop != manifest_start:
+        raise ValueError("bundle sections don't add up to its size")
+    if zlib.crc32(data[ids]) != ids_crc32:
+        raise ValueError("id map checksum mismatch")
+    return manifest, ids
+
+
+def _check_index(index, manifest):
+    if index.d != manifest["dim"] or index.ntotal != manifest["vectors"]:
+        raise ValueError(
+            f"index has {index.ntotal} vectors of dimension {index.d}, "
+            f"manifest says {manifest['vectors']} of dimension {manifest['dim']}"
+        )
+
+
+def read_bundle(data):
+    """Load a bundle from bytes into memory. Returns (index, ids as a mutable list, manifest)."""
+    manifest, ids = read_bundle_layout(data)
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    index = faiss.deserialize_index(buffer[:manifest["index_bytes"]])
+    _check_index(index, manifest)
+    return index, list(PackedIds(buffer[ids])), manifest
+
+
+def load_bundle_file(path):
+    """
+    Load a bundle file with memory mapping: FAISS maps the index codes
+    read-only (IO_FLAG_MMAP_IFC; plain IO_FLAG_MMAP still copies Flat and HNSW
+    codes) and the id map is a PackedIds view of the same file, so neither is
+    copied into memory up front. Returns (index, ids, manifest).
+    """
+    packed = np.memmap(path, dtype=np.uint8, mode="r")
+    manifest, ids = read_bundle_layout(packed)
+    index = faiss.read_index(str(path), faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+    _check_index(index, manifest)
+    return index, PackedIds(packed[ids]), manifest
+
+
+def bundle_object_name(index_version):
+    """Storage object name of the published bundle for index_version"""
+    return f"index-{index_version}.bundle.zst"
+
+
+def compress_bundle(data, level=3):
+    """zstd-compress a bundle for upload"""
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+def decompress_bundle(data):
+    """Return a downloaded bundle uncompressed; bundles stored before compression are returned as is"""
+    if bytes(data[:len(ZSTD_MAGIC)]) != ZSTD_MAGIC:
+        return data
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+def write_bundle_file(data, file):
+    """Write a downloaded bundle to an open binary file, decompressing it as a stream if needed"""
+    if bytes(data[:len(ZSTD_MAGIC)]) != ZSTD_MAGIC:
+        file.write(data)
+    else:
+        zstandard.ZstdDecompressor().copy_stream(io.BytesIO(data), file)
@@ -11,6 +11,16 @@ from dotenv import load_dotenv
 from supabase import create_client, Client
 import tempfile
 import io
+import json
+import random
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import chain
+from index_utils import (
+    decode_embeddings, chunk_summary, choose_index_spec, create_index, write_bundle, read_bundle,
+    spec_quantization, INDEX_POINTER_FILENAME, bundle_object_name, compress_bundle, decompress_bundle
+)
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -33,10 +43,63 @@ logger.info("✅ Supabase client initialized for indexing")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
 
+# Summaries packed into one embeddings request, bounded by input count and by
+# estimated tokens (the API allows 2048 inputs and 300k tokens per request)
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 256))
+EMBEDDING_BATCH_TOKENS = int(os.getenv("EMBEDDING_BATCH_TOKENS", 250_000))
+# Longest single input the embedding models accept
+EMBEDDING_MAX_INPUT_TOKENS = 8191
+# Embedding requests in flight at once, and retries for rate limits and server errors
+EMBEDDING_MAX_CONCURRENCY = int(os.getenv("EMBEDDING_MAX_CONCURRENCY", 4))
+EMBEDDING_MAX_RETRIES = int(os.getenv("EMBEDDING_MAX_RETRIES", 5))
+EMBEDDING_BACKOFF_BASE = float(os.getenv("EMBEDDING_BACKOFF_BASE", 1.0))
+EMBEDDING_BACKOFF_MAX = 60.0
+# Embeddings written back per update_document_embeddings call (and chunk rows per insert)
+EMBEDDING_WRITE_BATCH_SIZE = int(os.getenv("EMBEDDING_WRITE_BATCH_SIZE", 100))
+# Longest chunk of a summary embedded as one vector; summaries are split at page
+# sections first and sections longer than this are split further
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", 512))
+
+# Cleared once the database turns out not to have update_document_embeddings
+_bulk_write_available = True
+
 # Storage bucket configuration
 STORAGE_BUCKET = "user-indexes"
+# Each index version is published as its own zstd-compressed bundle object
+# (index, id map and manifest, see index_utils.write_bundle), and the pointer
+# object INDEX_POINTER_FILENAME is switched to it only after it has uploaded
+INDEX_COMPRESSION_LEVEL = int(os.getenv("INDEX_COMPRESSION_LEVEL", 3))
+# Uncompressed bundle without a pointer, written before versioned publishing
+INDEX_BUNDLE_FILENAME = "index.bundle"
+# Separate files written before the bundle format; read as a fallback and
+# garbage-collected once a bundle has been published
+INDEX_FILENAME = "faiss_index.idx"
+ID_MAP_FILENAME = "id_map.pkl"
+INDEX_PARAMS_FILENAME = "index_params.json"
+
+# Index type selection (see index_utils.choose_index_spec): exact Flat search up
+# to INDEX_FLAT_MAX_VECTORS chunks, HNSW above, IVF-SQ8 from INDEX_IVF_MIN_VECTORS;
+# search parameters are tuned for INDEX_RECALL_TARGET (recall@k vs exact search)
+INDEX_RECALL_TARGET = float(os.getenv("INDEX_RECALL_TARGET", 0.95))
+INDEX_FLAT_MAX_VECTORS = int(os.getenv("INDEX_FLAT_MAX_VECTORS", 20_000))
+INDEX_IVF_MIN_VECTORS = int(os.getenv("INDEX_IVF_MIN_VECTORS", 500_000))
+# How indexes store vectors: float32, fp16, sq8 (8-bit) or pq (product
+# quantization); unset keeps float32 for Flat/HNSW and sq8 for IVF. Recall
+# costs are measured by benchmarks/bench_quantization.py
+INDEX_QUANTIZATION = os.getenv("INDEX_QUANTIZATION") or None
+
+# Share of removed entries in an index's id map above which indexing rebuilds
+# the index from scratch instead of updating it in place
+INDEX_MAX_TOMBSTONE_RATIO = float(os.getenv("INDEX_MAX_TOMBSTONE_RATIO", 0.5))
+# Chunk ids per request when fetching embeddings by id
+FETCH_IDS_CHUNK_SIZE = 100
+# Chunks per page when streaming embeddings into the index builder
+INDEX_FETCH_PAGE_SIZE = int(os.getenv("INDEX_FETCH_PAGE_SIZE", 500))
+
+_user_locks = {}
+_user_locks_guard = threading.Lock()
 
-def upload_index_to_storage(user_id: str, index_data: bytes, filename: str):
+def upload_index_to_storage(user_id: str, index_data: bytes, filename: str, content_type: str = "application/octet-stream"):
     """Upload index file to Supabase Storage"""
     try:
         file_path = f"{user_id}/{filename}"
@@ -55,7 +118,7 @@ def upload_index_to_storage(user_id: str, index_data: bytes, filename: str):
         response = service_supabase.storage.from_(STORAGE_BUCKET).upload(
             path=file_path,
             file=index_data,
-            file_options={"content-type": "application/octet-stream"}
+            file_options={"content-type": content_type, "upsert": "true"}
         )
         
         logger.info(f"✅ Successfully uploaded {filename} to storage")
@@ -64,10 +127,10 @@ def upload_index_to_storage(user_id: str, index_data: bytes, filename: str):
         logger.error(f"❌ Error uploading {filename} to storage: {e}")
         return False
 
-def delete_user_indexes_from_storage(user_id: str):
-    """Delete all index files for a user from storage"""
+def delete_user_indexes_from_storage(user_id: str, keep=()):
+    """Delete all index files for a user from storage, except the file names in keep, in one request"""
     try:
-        logger.info(f"🗑️ Deleting all indexes for user {user_id} from storage")
+        logger.info(f"🗑️ Deleting indexes for user {user_id} from storage")
         
         # Create a service role client for storage operations
         SUPABASE_SERVICE_KEY = os.getenv("SUPABASE_SERVICE_KEY")
@@ -78,227 +141,585 @@ def delete_user_indexes_from_storage(user_id: str):
         # Create service client for storage operations
         service_supabase = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
         
-        # List all files for the user
+        # List all files for the user and remove them in a single batched call
         files = service_supabase.storage.from_(STORAGE_BUCKET).list(path=user_id)
+        file_paths = [f"{user_id}/{file_info['name']}" for file_info in files or [] if file_info['name'] not in keep]
+        if file_paths:
+            service_supabase.storage.from_(STORAGE_BUCKET).remove(file_paths)
+            logger.info(f"🗑️ Deleted {len(file_paths)} files: {', '.join(file_paths)}")
         
-        if files:
-            # Delete each file
-            for file_info in files:
-                file_path = f"{user_id}/{file_info['name']}"
-                service_supabase.storage.from_(STORAGE_BUCKET).remove([file_path])
-                logger.info(f"🗑️ Deleted {file_path}")
-        
-        logger.info(f"✅ Successfully deleted all indexes for user {user_id}")
+        logger.info(f"✅ Successfully deleted indexes for user {user_id}")
         return True
     except Exception as e:
         logger.error(f"❌ Error deleting indexes for user {user_id}: {e}")
         return False
 
+def _estimate_tokens(text: str) -> int:
+    """Conservative token estimate (about 3 characters per token)"""
+    return len(text) // 3 + 1
+
+def _iter_embedding_batches(items, batch_size=None, batch_tokens=None):
+    """Group (doc_id, text) items into batches within the input-count and token limits"""
+    batch_size = batch_size or EMBEDDING_BATCH_SIZE
+    batch_tokens = batch_tokens or EMBEDDING_BATCH_TOKENS
+    batch = []
+    tokens = 0
+    for doc_id, text in items:
+        text_tokens = _estimate_tokens(text)
+        if batch and (len(batch) >= batch_size or tokens + text_tokens > batch_tokens):
+            yield batch
+            batch = []
+            tokens = 0
+        batch.append((doc_id, text))
+        tokens += text_tokens
+    if batch:
+        yield batch
+
+def _is_retryable(error) -> bool:
+    return isinstance(error, (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError))
+
+def _embed_batch(openai_client, texts):
+    """Embed a batch of texts, retrying rate limits and server errors with jittered
+    exponential backoff. Returns (embeddings in input order, seconds, attempts)."""
+    start = time.perf_counter()
+    for attempt in range(EMBEDDING_MAX_RETRIES + 1):
+        try:
+            response = openai_client.embeddings.create(model=EMBEDDING_MODEL, input=texts)
+            embeddings = [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+            return embeddings, time.perf_counter() - start, attempt + 1
+        except Exception as e:
+            if not _is_retryable(e) or attempt == EMBEDDING_MAX_RETRIES:
+                raise
+            delay = min(EMBEDDING_BACKOFF_MAX, EMBEDDING_BACKOFF_BASE * 2 ** attempt)
+            delay = random.uniform(delay / 2, delay)
+            logger.warning(f"⚠️ Embedding request failed ({e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+def _save_embedding(doc_id, embedding) -> bool:
+    try:
+        # Update document in Supabase with embedding
+        supabase.table('documents').update({
+            'embedding': embedding
+        }).eq('id', doc_id).execute()
+        return True
+    except Exception as e:
+        logger.error(f"❌ Error saving embedding for document {doc_id}: {e}")
+        return False
+
+def save_embeddings(rows) -> list:
+    """
+    Write (doc_id, embedding) pairs back to Supabase in chunks of
+    EMBEDDING_WRITE_BATCH_SIZE through the update_document_embeddings function
+    (one round-trip per chunk), falling back to per-row updates for a chunk that
+    fails or if the function isn't installed. Returns the ids of the rows saved.
+    """
+    global _bulk_write_available
+    saved = []
+    for start in range(0, len(rows), EMBEDDING_WRITE_BATCH_SIZE):
+        chunk = rows[start:start + EMBEDDING_WRITE_BATCH_SIZE]
+        if _bulk_write_available:
+            try:
+                supabase.rpc('update_document_embeddings', {
+                    'doc_ids': [str(doc_id) for doc_id, _ in chunk],
+                    # pgvector parses '[x,y,...]' literals
+                    'doc_embeddings': [json.dumps(embedding, separators=(',', ':')) for _, embedding in chunk]
+                }).execute()
+                saved.extend(str(doc_id) for doc_id, _ in chunk)
+                continue
+            except Exception as e:
+                if "PGRST202" in str(e) or "Could not find the function" in str(e):
+                    logger.warning("⚠️ update_document_embeddings is not installed, writing embeddings row by row")
+                    _bulk_write_available = False
+                else:
+                    logger.warning(f"⚠️ Bulk embedding write failed ({e}), saving {len(chunk)} rows individually")
+        saved.extend(str(doc_id) for doc_id, embedding in chunk if _save_embedding(doc_id, embedding))
+    return saved
+
+def _document_chunks(documents):
+    """Split each document's summary into chunk rows (without embeddings), grouped by document id"""
+    max_chars = min(CHUNK_MAX_TOKENS, EMBEDDING_MAX_INPUT_TOKENS) * 3
+    chunks = {}
+    for doc in documents:
+        summary = doc.get("summary")
+        if not summary or not summary.strip():
+            logger.warning(f"⚠️ Skipping document {doc['id']} - no summary field.")
+            continue
+        doc_id = str(doc["id"])
+        chunks[doc_id] = [
+            {
+                "id": str(uuid.uuid4()),
+                "document_id": doc_id,
+                "user_id": doc["user_id"],
+                "chunk_index": number,
+                "page_label": label,
+                "content": content
+            }
+            for number, (label, content) in enumerate(chunk_summary(summary, max_chars))
+        ]
+    return chunks
+
+def _mean_embedding(chunks):
+    """Unit-length mean of the chunks' embeddings, stored as the document-level embedding"""
+    mean = np.mean([chunk["embedding"] for chunk in chunks], axis=0)
+    norm = np.linalg.norm(mean)
+    return (mean / norm if norm else mean).tolist()
+
+def save_document_chunks(documents) -> list:
+    """
+    Replace the stored chunks of each (doc_id, chunks) pair with the freshly
+    embedded ones, inserted EMBEDDING_WRITE_BATCH_SIZE rows per call, then save
+    the mean chunk embedding as the document embedding, which marks the document
+    as embedded. On failure the documents keep a null embedding and are picked up
+    by the next run. Returns the ids of the chunks saved.
+    """
+    rows = [dict(chunk) for _, chunks in documents for chunk in chunks]
+    try:
+        supabase.table('document_chunks').delete().in_('document_id', [doc_id for doc_id, _ in documents]).execute()
+        for start in range(0, len(rows), EMBEDDING_WRITE_BATCH_SIZE):
+            supabase.table('document_chunks').insert(rows[start:start + EMBEDDING_WRITE_BATCH_SIZE]).execute()
+    except Exception as e:
+        logger.error(f"❌ Error saving chunks for {len(documents)} documents: {e}")
+        return []
+    saved = set(save_embeddings([(doc_id, _mean_embedding(chunks)) for doc_id, chunks in documents]))
+    return [chunk["id"] for doc_id, chunks in documents if doc_id in saved for chunk in chunks]
+
+def embed_documents(openai_client, documents, progress_callback=None):
+    """
+    Split the summaries of documents into chunks (page sections within the
+    CHUNK_MAX_TOKENS budget) and embed the chunks in batched requests, several in
+    flight at once. As soon as every chunk of a document is embedded, the
+    document is written with save_document_chunks on a writer thread while later
+    batches are still being embedded. Returns the ids of the chunks saved, the
+    number of documents and chunks embedded and per-batch timings.
+    progress_callback(event, **details) is called with "documents_embedded"
+    (done, total, seconds) as each batch completes.
+    """
+    chunks = _document_chunks(documents)
+    items = [((doc_id, number), chunk["content"]) for doc_id, doc_chunks in chunks.items() for number, chunk in enumerate(doc_chunks)]
+    remaining = {doc_id: len(doc_chunks) for doc_id, doc_chunks in chunks.items()}
+    failed = set()
+    
+    batches = list(_iter_embedding_batches(items))
+    logger.info(f"🧮 Embedding {len(items)} chunks of {len(chunks)} documents in {len(batches)} requests ({EMBEDDING_MAX_CONCURRENCY} concurrent)...")
+    
+    done = 0
+    timings = []
+    writes = []
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedding-writer") as writer, \
+            ThreadPoolExecutor(max_workers=max(1, EMBEDDING_MAX_CONCURRENCY)) as executor:
+        futures = {executor.submit(_embed_batch, openai_client, [text for _, text in batch]): (number, batch) for number, batch in enumerate(batches, 1)}
+        for future in as_completed(futures):
+            number, batch = futures[future]
+            try:
+                embeddings, seconds, attempts = future.result()
+            except Exception as e:
+                # These documents keep a null embedding and are picked up by the next run
+                logger.error(f"❌ Embedding batch {number} ({len(batch)} chunks) failed: {e}")
+                embeddings, seconds = [None] * len(batch), 0.0
+            else:
+                timings.append({"batch": number, "inputs": len(batch), "seconds": round(seconds, 3), "attempts": attempts})
+                logger.info(f"⏱️ Batch {number}/{len(batches)}: {len(batch)} embeddings in {seconds:.2f}s ({attempts} attempt(s))")
+            
+            ready = []
+            for ((doc_id, chunk_number), _), embedding in zip(batch, embeddings):
+                if embedding is None:
+                    failed.add(doc_id)
+                else:
+                    chunks[doc_id][chunk_number]["embedding"] = embedding
+                remaining[doc_id] -= 1
+                if not remaining[doc_id]:
+                    done += 1
+                    if doc_id not in failed:
+                        ready.append((doc_id, chunks[doc_id]))
+            if ready:
+                writes.append(writer.submit(save_document_chunks, ready))
+            
+            if progress_callback:
+                progress_callback("documents_embedded", done=done, total=len(chunks), seconds=round(seconds, 3))
+    
+    embedded_ids = [chunk_id for write in writes for chunk_id in write.result()]
+    saved = set(embedded_ids)
+    embedded_documents = sum(doc_chunks[0]["id"] in saved for doc_chunks in chunks.values())
+    elapsed = time.perf_counter() - start
+    logger.info(f"✅ Embedded {len(embedded_ids)} chunks of {embedded_documents}/{len(chunks)} documents in {elapsed:.2f}s")
+    return {"ids": embedded_ids, "embedded": embedded_documents, "chunks": len(embedded_ids), "seconds": round(elapsed, 3), "batches": timings}
+
+def _iter_chunk_pages(user_id: str, columns: str, page_size=None):
+    """
+    Yield the user's embedded chunks (only the given columns) page by page,
+    using keyset pagination on id so every page is an indexed range scan and
+    memory stays bounded however many documents the user has.
+    """
+    page_size = page_size or INDEX_FETCH_PAGE_SIZE
+    last_id = None
+    while True:
+        query = supabase.table('document_chunks').select(columns).not_.is_('embedding', 'null').eq('user_id', user_id)
+        if last_id is not None:
+            query = query.gt('id', last_id)
+        page = query.order('id').limit(page_size).execute().data
+        if page:
+            yield page
+        if len(page) < page_size:
+            return
+        last_id = page[-1]['id']
+
+def _fetch_documents_to_embed(user_id: str) -> list:
+    """
+    The user's documents that have no embedding or no chunks. Documents embedded
+    before summaries were chunked, or whose chunking failed after that, still
+    have their old whole-summary embedding but no chunk rows, so the index would
+    never hold them.
+    """
+    columns = 'id, user_id, summary'
+    documents = {doc['id']: doc for doc in supabase.table('documents').select(columns).eq('user_id', user_id).is_('embedding', 'null').execute().data}
+    # Anti-join: the embedded document_chunks resource is null for documents without chunks
+    unchunked = supabase.table('documents').select(f'{columns}, document_chunks(id)').eq('user_id', user_id).is_('document_chunks', 'null').execute().data
+    for doc in unchunked:
+        doc.pop('document_chunks', None)
+        documents.setdefault(doc['id'], doc)
+    return list(documents.values())
+
+def _fetch_embedded_ids(user_id: str) -> set:
+    """Ids of every chunk of the user that has an embedding"""
+    return {str(chunk['id']) for page in _iter_chunk_pages(user_id, 'id') for chunk in page}
+
+def _iter_embedding_pages(user_id: str, chunk_ids=None):
+    """Yield pages of id and embedding of the user's embedded chunks (only chunk_ids, if given)"""
+    if chunk_ids is None:
+        yield from _iter_chunk_pages(user_id, 'id, embedding')
+        return
+    chunk_ids = list(chunk_ids)
+    for start in range(0, len(chunk_ids), FETCH_IDS_CHUNK_SIZE):
+        ids = chunk_ids[start:start + FETCH_IDS_CHUNK_SIZE]
+        yield supabase.table('document_chunks').select('id, embedding').in_('id', ids).eq('user_id', user_id).execute().data
+
+def _index_spec(count: int, dim: int):
+    return choose_index_spec(count, dim, INDEX_RECALL_TARGET, INDEX_FLAT_MAX_VECTORS, INDEX_IVF_MIN_VECTORS, INDEX_QUANTIZATION)
+
+def _iter_decoded(pages):
+    """Decode pages of embeddings, yielding (chunk_ids, matrix) for each page with valid embeddings"""
+    for page in pages:
+        ids, embeddings = decode_embeddings(page)
+        if ids:
+            yield ids, embeddings
+
+def _add_embeddings(index, chunk_ids: list, batches, progress_callback, train_size=0):
+    """
+    Append decoded (ids, embeddings) batches to the index and id map as they
+    arrive; each vector's FAISS id is its position in the id map. An untrained
+    index (IVF) is trained on the first train_size vectors before they are added.
+    Returns the number of vectors added, or None if an embedding doesn't match
+    the index dimension.
+    """
+    added = 0
+    pending_ids, pending = [], []
+    # A final None flushes vectors still held back for training
+    for batch in chain(batches, [None]):
+        ids, embeddings = batch or (None, None)
+        if ids is not None and embeddings.shape[1] != index.d:
+            logger.warning(f"⚠️ Embedding dimension changed ({index.d} -> {embeddings.shape[1]})")
+            return None
+        if not index.is_trained:
+            # Hold vectors back until there are enough to train on (or no more arrive)
+            if ids is not None:
+                pending_ids.extend(ids)
+                pending.append(embeddings)
+                if len(pending_ids) < train_size:
+                    continue
+            if not pending_ids:
+                break
+            ids, embeddings = pending_ids, np.vstack(pending)
+            pending_ids, pending = [], []
+            logger.info(f"🎯 Training index on {len(ids)} vectors...")
+            index.train(embeddings)
+        if ids is None:
+            break
+        index.add_with_ids(embeddings, np.arange(len(chunk_ids), len(chunk_ids) + len(ids), dtype="int64"))
+        chunk_ids.extend(ids)
+        added += len(ids)
+        progress_callback("documents_loaded", count=added)
+    return added
+
+def _read_index_pointer(service_supabase, user_id: str):
+    """The user's published index pointer, or None if nothing has been published"""
+    try:
+        return json.loads(service_supabase.storage.from_(STORAGE_BUCKET).download(f"{user_id}/{INDEX_POINTER_FILENAME}"))
+    except Exception as e:
+        logger.info(f"ℹ️ No published index pointer for user {user_id} ({e})")
+        return None
+
+def _download_bundle(service_supabase, user_id: str):
+    """Download and decompress the user's current bundle, or return None if there is none"""
+    pointer = _read_index_pointer(service_supabase, user_id)
+    filename = pointer["object"] if pointer else INDEX_BUNDLE_FILENAME
+    try:
+        return decompress_bundle(service_supabase.storage.from_(STORAGE_BUCKET).download(f"{user_id}/{filename}"))
+    except Exception as e:
+        logger.info(f"ℹ️ No index bundle {filename} for user {user_id} ({e})")
+        return None
+
+def download_user_index(user_id: str):
+    """
+    Download the user's current index, id map and index spec, or return
+    (None, None, None) if there is none. The published bundle is read first,
+    then the separate files of older indexes; indexes stored before index
+    selection have no spec and are flat.
+    """
+    service_supabase = create_client(SUPABASE_URL, os.getenv("SUPABASE_SERVICE_KEY"))
+    bundle_data = _download_bundle(service_supabase, user_id)
+    if bundle_data is not None:
+        try:
+            index, chunk_ids, manifest = read_bundle(bundle_data)
+        except Exception as e:
+            logger.warning(f"⚠️ Ignoring unreadable index bundle for user {user_id}: {e}")
+            return None, None, None
+        if manifest.get("embedding_model") != EMBEDDING_MODEL:
+            logger.warning(f"⚠️ Index was built with {manifest.get('embedding_model')} embeddings but EMBEDDING_MODEL is {EMBEDDING_MODEL}; re-embed the user's documents")
+        spec = manifest["spec"]
+        logger.info(f"📥 Loaded existing {spec['type']} index for user {user_id} ({index.ntotal} vectors, version {manifest['index_version']})")
+        return index, chunk_ids, spec
+
+    try:
+        index_data = service_supabase.storage.from_(STORAGE_BUCKET).download(f"{user_id}/{INDEX_FILENAME}")
+        id_map_data = service_supabase.storage.from_(STORAGE_BUCKET).download(f"{user_id}/{ID_MAP_FILENAME}")
+        index = faiss.deserialize_index(np.frombuffer(index_data, dtype="uint8"))
+        chunk_ids = pickle.loads(id_map_data)
+    except Exception as e:
+        logger.info(f"ℹ️ No existing index loaded for user {user_id}: {e}")
+        return None, None, None
+    try:
+        spec = json.loads(service_supabase.storage.from_(STORAGE_BUCKET).download(f"{user_id}/{INDEX_PARAMS_FILENAME}"))
+    except Exception:
+        spec = {"type": "flat", "factory": "IDMap2,Flat", "search": {}}
+    logger.info(f"📥 Loaded existing {spec['type']} index for user {user_id} ({index.ntotal} vectors)")
+    return index, chunk_ids, spec
+
+def upload_user_index(user_id: str, index, chunk_ids: list, spec: dict):
+    """
+    Publish a new version of the user's index: upload it as a new compressed
+    bundle object, switch the pointer to it, then garbage-collect older
+    objects. Until the pointer is switched readers keep getting the previous
+    version, and that version is kept for readers that already read the old
+    pointer; any failure before the switch leaves the published index untouched.
+    """
+    logger.info("💾 Saving FAISS index to storage...")
+    bundle_data, manifest = write_bundle(index, chunk_ids, {"embedding_model": EMBEDDING_MODEL, "quantization": spec_quantization(spec), "spec": spec})
+    compressed = compress_bundle(bundle_data, INDEX_COMPRESSION_LEVEL)
+    object_name = bundle_object_name(manifest["index_version"])
+
+    if upload_index_to_storage(user_id, compressed, object_name):
+        logger.info(f"✅ Index bundle uploaded for user {user_id} ({len(bundle_data) / 2**20:.1f} MB, {len(compressed) / 2**20:.1f} MB compressed)")
+    else:
+        raise Exception("Failed to upload index bundle to storage")
+
+    service_supabase = create_client(SUPABASE_URL, os.getenv("SUPABASE_SERVICE_KEY"))
+    previous = _read_index_pointer(service_supabase, user_id)
+    pointer = {
+        "version": manifest["index_version"],
+        "object": object_name,
+        "built_at": manifest["built_at"],
+        "embedding_model": manifest["embedding_model"],
+        "count": manifest["count"],
+        "bytes": len(bundle_data),
+        "compressed_bytes": len(compressed)
+    }
+    if upload_index_to_storage(user_id, json.dumps(pointer).encode(), INDEX_POINTER_FILENAME, "application/json"):
+        logger.info(f"✅ Published index version {pointer['version']} for user {user_id}")
+    else:
+        raise Exception("Failed to publish index pointer")
+
+    # Remove everything else: older versions, pre-bundle files and objects of failed publishes
+    keep = {INDEX_POINTER_FILENAME, object_name} | ({previous["object"]} if previous else set())
+    delete_user_indexes_from_storage(user_id, keep)
+
+def _build_full_index(user_id: str, progress_callback):
+    """
+    Build the user's index from every embedded chunk, page by page, with the
+    index type chosen for the corpus size. Returns (index, chunk_ids, spec).
+    """
+    chunk_ids = []
+    try:
+        count = len(_fetch_embedded_ids(user_id))
+        batches = _iter_decoded(_iter_embedding_pages(user_id))
+        first = next(batches, None)
+        if first is None:
+            logger.error("❌ No embeddings found to build FAISS index.")
+            raise Exception("No embeddings found to build FAISS index.")
+        
+        dim = first[1].shape[1]
+        spec = _index_spec(count, dim)
+        logger.info(f"🏗️ Building new {spec['factory']} index for {count} chunks (search {spec['search'] or 'exact'})...")
+        index = create_index(spec, dim)
+        added = _add_embeddings(index, chunk_ids, chain([first], batches), progress_callback, spec["train_size"])
+    except Exception as e:
+        logger.error(f"❌ Error building index from chunks with embeddings: {e}")
+        raise
+
+    if added is None:
+        raise Exception("Embeddings of different dimensions found, re-embed the user's documents")
+    logger.info(f"✅ Built index with {index.ntotal} embeddings of dimension {index.d}")
+    return index, chunk_ids, spec
+
+def _update_index(user_id: str, index, chunk_ids: list, spec: dict, refreshed_ids: set, progress_callback):
+    """
+    Bring an existing index up to date in place: remove vectors of chunks that
+    were deleted (with their document, or replaced when it was re-embedded), and
+    add vectors of chunks not yet indexed. HNSW indexes can't remove vectors, so
+    theirs are only dropped from the id map (search excludes them) until the next
+    rebuild. Returns (vectors_added, vectors_removed), or None if a full rebuild
+    is due, including when the corpus has grown into a different index type.
+    """
+    embedded_ids = _fetch_embedded_ids(user_id)
+    positions = {chunk_id: position for position, chunk_id in enumerate(chunk_ids) if chunk_id is not None}
+    stale = [position for chunk_id, position in positions.items() if chunk_id not in embedded_ids or chunk_id in refreshed_ids]
+    to_add = [chunk_id for chunk_id in embedded_ids if chunk_id not in positions or chunk_id in refreshed_ids]
+
+    live = len(positions) - len(stale) + len(to_add)
+    if live == 0:
+        logger.error("❌ No embeddings found to build FAISS index.")
+        raise Exception("No embeddings found to build FAISS index.")
+    tombstones = len(chunk_ids) + len(to_add) - live
+    if tombstones > INDEX_MAX_TOMBSTONE_RATIO * (len(chunk_ids) + len(to_add)):
+        logger.info(f"🧹 {tombstones} removed entries in the id map, rebuilding instead of updating")
+        return None
+    wanted = _index_spec(live, index.d)
+    if wanted["type"] != spec["type"]:
+        logger.info(f"🔄 {live} chunks call for a {wanted['type']} index instead of {spec['type']}, rebuilding")
+        return None
+    if wanted["quantization"] != spec_quantization(spec):
+        logger.info(f"🔄 Index stores {spec_quantization(spec)} vectors instead of {wanted['quantization']}, rebuilding")
+        return None
+    if spec.get("train_size") and live > 4 * spec["count"]:
+        logger.info(f"🔄 Corpus grew from {spec['count']} to {live} chunks since the index was trained, rebuilding")
+        return None
+
+    if stale:
+        if spec["type"] != "hnsw":
+            index.remove_ids(np.array(stale, dtype="int64"))
+        for position in stale:
+            chunk_ids[position] = None
+
+    added = 0
+    if to_add:
+        added = _add_embeddings(index, chunk_ids, _iter_decoded(_iter_embedding_pages(user_id, to_add)), progress_callback)
+        if added is None:
+            logger.info("🔄 Rebuilding index for the new embedding dimension")
+            return None
+
+    logger.info(f"✅ Index updated incrementally: {added} added, {len(stale)} removed, {index.ntotal} total")
+    return added, len(stale)
+
 def main():
     # Parse command line arguments
     parser = argparse.ArgumentParser(description='Index documents for RAG system')
     parser.add_argument('--user-id', type=str, required=True, help='User ID to index documents for')
     parser.add_argument('--force-rebuild', action='store_true', help='Force rebuild the entire index (fixes UUID mismatch)')
     args = parser.parse_args()
-    
+
     # If force rebuild is requested, do that instead
     if args.force_rebuild:
         logger.info("🔄 Force rebuild requested...")
         force_rebuild_index(args.user_id)
         return
-    
-    logger.info(f"🚀 Starting indexing process for user: {args.user_id}")
-    
+
+    run_indexing(args.user_id)
+
+def _user_lock(user_id: str):
+    """Lock serializing index builds for one user, so concurrent requests never build the same index twice"""
+    with _user_locks_guard:
+        return _user_locks.setdefault(user_id, threading.Lock())
+
+def run_indexing(user_id: str, progress_callback=None):
+    """
+    Chunk and embed the user's documents that have no embedding or no chunks
+    yet and bring their FAISS index of chunk vectors up to date. The existing
+    index is updated incrementally (only new chunks' vectors are added, those of
+    deleted or re-embedded documents removed); it is rebuilt from scratch when
+    there is none, it predates ID-mapped indexes, or too many removed entries
+    have accumulated. Returns a summary of the run:
+    {"documents_found", "documents_embedded", "chunks_embedded", "embedding_seconds",
+    "embedding_batches", "total_chunks", "index_type", "quantization", "mode", "vectors_added", "vectors_removed"}.
+    progress_callback(event, **details) is called with "documents_found" (count),
+    "documents_embedded" (done, total, seconds), "documents_loaded" (chunk count),
+    "index_built" (vectors) and "index_uploaded".
+    """
+    with _user_lock(user_id):
+        return _run_indexing(user_id, progress_callback or (lambda event, **details: None))
+
+def _run_indexing(user_id: str, progress_callback):
+    logger.info(f"🚀 Starting indexing process for user: {user_id}")
+
     try:
         # Initialize OpenAI client
         logger.info("🤖 Initializing OpenAI client...")
         openai_client = openai.OpenAI(api_key=OPENAI_API_KEY)
 
-        # Delete existing user indexes from storage
-        delete_user_indexes_from_storage(args.user_id)
+        # Step 1: Get documents without embeddings or chunks from Supabase for this user
+        logger.info("📊 Fetching documents without embeddings or chunks from Supabase...")
 
-        # Step 1: Get documents without embeddings from Supabase for this user
-        logger.info("📊 Fetching documents without embeddings from Supabase...")
-        
         try:
-            # Build query for documents without embeddings for specific user
-            query = supabase.table('documents').select('*').is_('embedding', 'null').eq('user_id', args.user_id)
-            response = query.execute()
-            documents_to_embed = response.data
-            logger.info(f"📄 Found {len(documents_to_embed)} documents to embed for user {args.user_id}...")
+            documents_to_embed = _fetch_documents_to_embed(user_id)
+            logger.info(f"📄 Found {len(documents_to_embed)} documents to embed for user {user_id}...")
+            progress_callback("documents_found", count=len(documents_to_embed))
         except Exception as e:
             logger.error(f"❌ Error fetching documents from Supabase: {e}")
             raise
 
-        # Step 2: Generate embeddings for documents without them
-        for i, doc in enumerate(documents_to_embed):
-            summary = doc.get("summary")
-            if not summary:
-                logger.warning(f"⚠️ Skipping document {doc['id']} - no summary field.")
-                continue
-
-            logger.info(f"🔄 Processing document {i+1}/{len(documents_to_embed)}: {doc.get('file_name', 'Unknown')}")
-
-            try:
-                # Generate embedding
-                response = openai_client.embeddings.create(
-                    model=EMBEDDING_MODEL,
-                    input=summary
-                )
-                embedding = response.data[0].embedding
-
-                # Update document in Supabase with embedding
-                supabase.table('documents').update({
-                    'embedding': embedding
-                }).eq('id', doc['id']).execute()
-
-                logger.info(f"✅ Embedded and updated document {doc['id']}")
-
-            except Exception as e:
-                logger.error(f"❌ Error processing document {doc['id']}: {e}")
-                time.sleep(5)  # Wait before next attempt
-
-        # Step 3: Load all documents with embeddings from Supabase for this user
-        logger.info("📊 Loading all documents with embeddings from Supabase...")
-        
-        try:
-            # Build query for documents with embeddings for specific user
-            query = supabase.table('documents').select('*').not_.is_('embedding', 'null').eq('user_id', args.user_id)
-            response = query.execute()
-            documents = response.data
-            logger.info(f"📄 Loaded {len(documents)} documents with embeddings for user {args.user_id}.")
-        except Exception as e:
-            logger.error(f"❌ Error loading documents with embeddings: {e}")
-            raise
+        # Step 2: Chunk and embed the documents without embeddings
+        embedding_stats = embed_documents(openai_client, documents_to_embed, progress_callback)
 
-        if not documents:
-            logger.error("❌ No embeddings found to build FAISS index.")
-            raise Exception("No embeddings found to build FAISS index.")
+        # Step 3: Update the existing index, or build a new one
+        index, chunk_ids, spec = download_user_index(user_id)
+        changes = None
+        if index is not None and isinstance(index, faiss.IndexIDMap2):
+            changes = _update_index(user_id, index, chunk_ids, spec, set(embedding_stats["ids"]), progress_callback)
+        elif index is not None:
+            logger.info("🔄 Existing index is not ID-mapped, rebuilding it")
 
-        # Step 4: Prepare data for FAISS
-        logger.info("🔧 Preparing data for FAISS index...")
-        
-        # Convert embeddings to proper format
-        processed_embeddings = []
-        for doc in documents:
-            embedding_data = doc["embedding"]
-            
-            # Handle different embedding data types
-            if isinstance(embedding_data, str):
-                # If it's a string, try to evaluate it as a list
-                try:
-                    import ast
-                    embedding_list = ast.literal_eval(embedding_data)
-                    processed_embeddings.append(embedding_list)
-                    logger.info(f"✅ Converted string embedding to list for document {doc['id']}")
-                except Exception as e:
-                    logger.error(f"❌ Failed to parse embedding string for document {doc['id']}: {e}")
-                    continue
-            elif isinstance(embedding_data, list):
-                # If it's already a list, use it directly
-                processed_embeddings.append(embedding_data)
-            else:
-                logger.error(f"❌ Unknown embedding data type for document {doc['id']}: {type(embedding_data)}")
-                continue
-        
-        if not processed_embeddings:
-            logger.error("❌ No valid embeddings found to build FAISS index.")
-            raise Exception("No valid embeddings found to build FAISS index.")
-        
-        # Convert to numpy array
-        embeddings = np.array(processed_embeddings).astype("float32")
-        
-        # Get doc_ids that correspond to the processed embeddings
-        doc_ids = []
-        for doc in documents:
-            embedding_data = doc["embedding"]
-            if isinstance(embedding_data, str):
-                try:
-                    import ast
-                    ast.literal_eval(embedding_data)  # Test if it can be parsed
-                    doc_ids.append(str(doc["id"]))
-                except:
-                    continue
-            elif isinstance(embedding_data, list):
-                doc_ids.append(str(doc["id"]))
-        
-        logger.info(f"✅ Prepared {len(embeddings)} embeddings with shape {embeddings.shape}")
-        logger.info(f"✅ Matched {len(doc_ids)} document IDs")
+        if changes is None:
+            mode = "full"
+            index, chunk_ids, spec = _build_full_index(user_id, progress_callback)
+            vectors_added, vectors_removed = index.ntotal, 0
+        else:
+            mode = "incremental"
+            vectors_added, vectors_removed = changes
+        progress_callback("index_built", vectors=index.ntotal)
 
-        # Step 5: Build new FAISS index
-        logger.info("🏗️ Building new FAISS index...")
-        embedding_dim = embeddings.shape[1]
-        index = faiss.IndexFlatL2(embedding_dim)
-        index.add(embeddings)
+        # Step 4: Upload the index and id map (skipped when nothing changed)
+        if mode == "full" or vectors_added or vectors_removed:
+            upload_user_index(user_id, index, chunk_ids, spec)
+        else:
+            logger.info("✅ Index already up to date, nothing to upload")
+        progress_callback("index_uploaded")
 
-        # Step 6: Save index and map to temporary files, then upload to storage
-        logger.info("💾 Saving FAISS index to storage...")
-        
-        # Save FAISS index to bytes
-        temp_idx_path = None
-        temp_pkl_path = None
-        
-        try:
-            with tempfile.NamedTemporaryFile(suffix='.idx', delete=False) as temp_idx:
-                temp_idx_path = temp_idx.name
-                faiss.write_index(index, temp_idx_path)
-            
-            # Read the file after writing
-            with open(temp_idx_path, 'rb') as f:
-                index_data = f.read()
-            
-            # Save ID map to bytes
-            with tempfile.NamedTemporaryFile(suffix='.pkl', delete=False) as temp_pkl:
-                temp_pkl_path = temp_pkl.name
-                with open(temp_pkl_path, 'wb') as f:
-                    pickle.dump(doc_ids, f)
-            
-            # Read the pickle file after writing
-            with open(temp_pkl_path, 'rb') as f:
-                id_map_data = f.read()
-            
-            # Upload to Supabase Storage
-            if upload_index_to_storage(args.user_id, index_data, "faiss_index.idx"):
-                logger.info(f"✅ FAISS index uploaded to storage for user {args.user_id}")
-            else:
-                raise Exception("Failed to upload FAISS index to storage")
-            
-            if upload_index_to_storage(args.user_id, id_map_data, "id_map.pkl"):
-                logger.info(f"✅ ID map uploaded to storage for user {args.user_id}")
-            else:
-                raise Exception("Failed to upload ID map to storage")
-                
-        finally:
-            # Clean up temporary files with proper error handling
-            if temp_idx_path and os.path.exists(temp_idx_path):
-                try:
-                    os.unlink(temp_idx_path)
-                    logger.info("🧹 Temporary FAISS index file cleaned up")
-                except Exception as e:
-                    logger.warning(f"⚠️ Could not delete temporary FAISS index file: {e}")
-            
-            if temp_pkl_path and os.path.exists(temp_pkl_path):
-                try:
-                    os.unlink(temp_pkl_path)
-                    logger.info("🧹 Temporary ID map file cleaned up")
-                except Exception as e:
-                    logger.warning(f"⚠️ Could not delete temporary ID map file: {e}")
-
-        # Step 7: Update indexed_at timestamp for all processed documents
+        # Step 5: Update indexed_at timestamp for all processed documents
         logger.info("🕒 Updating indexed_at timestamps...")
         try:
             # Build update query for documents with embeddings for specific user
             update_query = supabase.table('documents').update({
                 'indexed_at': time.strftime('%Y-%m-%dT%H:%M:%SZ')
-            }).not_.is_('embedding', 'null').eq('user_id', args.user_id)
-            
+            }).not_.is_('embedding', 'null').eq('user_id', user_id)
+
             update_query.execute()
             logger.info("✅ Indexed timestamps updated successfully")
         except Exception as e:
             logger.warning(f"⚠️ Could not update indexed timestamps: {e}")
 
-        logger.info("🎉 Indexing completed successfully!")
-        return True
+        logger.info(f"🎉 Indexing completed successfully ({mode})!")
+        return {
+            "documents_found": len(documents_to_embed),
+            "documents_embedded": embedding_stats["embedded"],
+            "chunks_embedded": embedding_stats["chunks"],
+            "embedding_seconds": embedding_stats["seconds"],
+            "embedding_batches": embedding_stats["batches"],
+            "total_chunks": index.ntotal,
+            "index_type": spec["type"],
+            "quantization": spec_quantization(spec),
+            "mode": mode,
+            "vectors_added": vectors_added,
+            "vectors_removed": vectors_removed
+        }
 
     except Exception as e:
         logger.error(f"❌ Error during indexing: {e}")
@@ -306,116 +727,21 @@ def main():
 
 def force_rebuild_index(user_id: str):
     """Force rebuild the FAISS index and ID map to ensure correct UUIDs"""
+    with _user_lock(user_id):
+        return _force_rebuild_index(user_id)
+
+def _force_rebuild_index(user_id: str):
     logger.info(f"🔄 Force rebuilding FAISS index and ID map for user {user_id}...")
-    
+
     try:
-        # Delete existing user indexes from storage
-        delete_user_indexes_from_storage(user_id)
-        
-        # Get all documents with embeddings from Supabase for this user
-        logger.info("📊 Fetching all documents with embeddings from Supabase...")
-        response = supabase.table('documents').select('*').not_.is_('embedding', 'null').eq('user_id', user_id).execute()
-        documents = response.data
-        logger.info(f"📄 Found {len(documents)} documents with embeddings for user {user_id}")
-        
-        if not documents:
-            logger.error("❌ No documents with embeddings found")
-            return False
-        
-        # Process embeddings
-        processed_embeddings = []
-        doc_ids = []
-        
-        for doc in documents:
-            embedding_data = doc["embedding"]
-            
-            # Handle different embedding data types
-            if isinstance(embedding_data, str):
-                try:
-                    import ast
-                    embedding_list = ast.literal_eval(embedding_data)
-                    processed_embeddings.append(embedding_list)
-                    doc_ids.append(str(doc["id"]))
-                    logger.info(f"✅ Processed string embedding for document {doc['id']}")
-                except Exception as e:
-                    logger.error(f"❌ Failed to parse embedding for document {doc['id']}: {e}")
-                    continue
-            elif isinstance(embedding_data, list):
-                processed_embeddings.append(embedding_data)
-                doc_ids.append(str(doc["id"]))
-                logger.info(f"✅ Processed array embedding for document {doc['id']}")
-            else:
-                logger.error(f"❌ Unknown embedding type for document {doc['id']}: {type(embedding_data)}")
-                continue
-        
-        if not processed_embeddings:
-            logger.error("❌ No valid embeddings found")
-            return False
-        
-        # Convert to numpy array
-        embeddings = np.array(processed_embeddings).astype("float32")
-        logger.info(f"✅ Prepared {len(embeddings)} embeddings with shape {embeddings.shape}")
-        logger.info(f"✅ Matched {len(doc_ids)} document IDs")
-        
-        # Build new FAISS index
-        logger.info("🏗️ Building new FAISS index...")
-        embedding_dim = embeddings.shape[1]
-        index = faiss.IndexFlatL2(embedding_dim)
-        index.add(embeddings)
-
-        # Save index and map to temporary files, then upload to storage
-        logger.info("💾 Saving new FAISS index to storage...")
-        
-        # Save FAISS index to bytes
-        temp_idx_path = None
-        temp_pkl_path = None
-        
+        # The current index stays published until the rebuilt one replaces it
         try:
-            with tempfile.NamedTemporaryFile(suffix='.idx', delete=False) as temp_idx:
-                temp_idx_path = temp_idx.name
-                faiss.write_index(index, temp_idx_path)
-            
-            # Read the file after writing
-            with open(temp_idx_path, 'rb') as f:
-                index_data = f.read()
-            
-            # Save ID map to bytes
-            with tempfile.NamedTemporaryFile(suffix='.pkl', delete=False) as temp_pkl:
-                temp_pkl_path = temp_pkl.name
-                with open(temp_pkl_path, 'wb') as f:
-                    pickle.dump(doc_ids, f)
-            
-            # Read the pickle file after writing
-            with open(temp_pkl_path, 'rb') as f:
-                id_map_data = f.read()
-            
-            # Upload to Supabase Storage
-            if upload_index_to_storage(user_id, index_data, "faiss_index.idx"):
-                logger.info(f"✅ FAISS index uploaded to storage for user {user_id}")
-            else:
-                raise Exception("Failed to upload FAISS index to storage")
-            
-            if upload_index_to_storage(user_id, id_map_data, "id_map.pkl"):
-                logger.info(f"✅ ID map uploaded to storage for user {user_id}")
-            else:
-                raise Exception("Failed to upload ID map to storage")
-                
-        finally:
-            # Clean up temporary files with proper error handling
-            if temp_idx_path and os.path.exists(temp_idx_path):
-                try:
-                    os.unlink(temp_idx_path)
-                    logger.info("🧹 Temporary FAISS index file cleaned up")
-                except Exception as e:
-                    logger.warning(f"⚠️ Could not delete temporary FAISS index file: {e}")
-            
-            if temp_pkl_path and os.path.exists(temp_pkl_path):
-                try:
-                    os.unlink(temp_pkl_path)
-                    logger.info("🧹 Temporary ID map file cleaned up")
-                except Exception as e:
-                    logger.warning(f"⚠️ Could not delete temporary ID map file: {e}")
+            index, chunk_ids, spec = _build_full_index(user_id, lambda event, **details: None)
+        except Exception as e:
+            logger.error(f"❌ {e}")
+            return False
 
+        upload_user_index(user_id, index, chunk_ids, spec)
         logger.info("🎉 Force rebuild completed successfully!")
         return True
 
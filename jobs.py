@@ -0,0 +1,199 @@
+import os
+import json
+import uuid
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Load environment variables from .env
+load_dotenv()
+
+JOBS_DB_PATH = os.getenv("JOBS_DB_PATH", "jobs.db")
+# Jobs processed at the same time; further jobs wait in the queue
+JOBS_MAX_WORKERS = int(os.getenv("JOBS_MAX_WORKERS", 2))
+# Jobs allowed to wait before new submissions are rejected
+JOBS_MAX_QUEUED = int(os.getenv("JOBS_MAX_QUEUED", 50))
+# Jobs whose progress event log is kept in memory for streaming
+JOBS_EVENTS_RETAINED = int(os.getenv("JOBS_EVENTS_RETAINED", 200))
+
+JOB_COLUMNS = [
+    "id", "user_id", "kind", "status", "filename", "stage",
+    "total_pages", "pages_done", "result", "error", "created_at", "updated_at"
+]
+
+
+class QueueFullError(Exception):
+    """Raised when a job is submitted while the queue is at capacity."""
+
+
+class JobQueue:
+    """
+    In-process job queue backed by a worker thread pool, with job records
+    persisted in SQLite so status survives until the client picks it up.
+
+    Job functions are called as fn(job_id, *args) and their return value
+    (JSON-serializable) becomes the job result.
+
+    Each job also has an in-memory log of progress events ("queued", "started",
+    whatever the job function emits, then "completed" or "failed") that clients
+    can stream; only the most recent JOBS_EVENTS_RETAINED logs are kept.
+    """
+
+    def __init__(self, db_path=JOBS_DB_PATH, max_workers=JOBS_MAX_WORKERS, max_queued=JOBS_MAX_QUEUED, kind_workers=None):
+        self.db_path = db_path
+        self.max_queued = max_queued
+        self._lock = threading.Lock()
+        self._events = OrderedDict()
+        self._events_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job-worker")
+        # Kinds with their own worker pool, so e.g. long indexing runs don't hold up uploads
+        self._kind_executors = {
+            kind: ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"{kind}-worker")
+            for kind, workers in (kind_workers or {}).items()
+        }
+        self._init_db()
+        logger.info(f"✅ Job queue initialized ({max_workers} workers, db: {db_path})")
+
+    @contextmanager
+    def _connect(self):
+        """Connection for one transaction: committed (or rolled back) and closed on exit"""
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def _init_db(self):
+        with self._lock, self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    user_id TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    filename TEXT,
+                    stage TEXT,
+                    total_pages INTEGER,
+                    pages_done INTEGER NOT NULL DEFAULT 0,
+                    result TEXT,
+                    error TEXT,
+                    created_at TEXT NOT NULL,
+                    updated_at TEXT NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_user_id_idx ON jobs(user_id)")
+            # Jobs that were in flight when the previous process stopped can never finish
+            interrupted = conn.execute(
+                "UPDATE jobs SET status = 'failed', error = 'Interrupted by server restart', updated_at = ? "
+                "WHERE status IN ('queued', 'running')",
+                (datetime.utcnow().isoformat(),)
+            ).rowcount
+            if interrupted:
+                logger.warning(f"⚠️ Marked {interrupted} interrupted jobs as failed")
+
+    def _count_waiting(self, conn):
+        return conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+
+    def submit(self, user_id, kind, fn, *args, filename=None):
+        """Create a job record and schedule fn on the worker pool. Returns the job id."""
+        job_id = str(uuid.uuid4())
+        now = datetime.utcnow().isoformat()
+        # Count and insert in one write transaction, so concurrent submits
+        # (from any process sharing the database) can't overshoot max_queued
+        with self._lock, self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            if self._count_waiting(conn) >= self.max_queued:
+                logger.warning(f"⚠️ Job queue full ({self.max_queued} waiting), rejecting {kind} job")
+                raise QueueFullError("Too many jobs are waiting. Please try again shortly.")
+            conn.execute(
+                "INSERT INTO jobs (id, user_id, kind, status, filename, stage, created_at, updated_at) "
+                "VALUES (?, ?, ?, 'queued', ?, 'queued', ?, ?)",
+                (job_id, user_id, kind, filename, now, now)
+            )
+        logger.info(f"📥 Queued {kind} job {job_id} for user {user_id}")
+        self.emit(job_id, "queued")
+        self._kind_executors.get(kind, self._executor).submit(self._run, job_id, fn, args)
+        return job_id
+
+    def _run(self, job_id, fn, args):
+        self.update(job_id, status="running", stage="running")
+        self.emit(job_id, "started")
+        try:
+            result = fn(job_id, *args)
+            self.update(job_id, status="completed", stage="completed", result=result)
+            self.emit(job_id, "completed", result=result)
+            logger.info(f"✅ Job {job_id} completed")
+        except Exception as e:
+            logger.error(f"❌ Job {job_id} failed: {e}")
+            self.update(job_id, status="failed", stage="failed", error=str(e))
+            self.emit(job_id, "failed", error=str(e))
+
+    def emit(self, job_id, event, **data):
+        """Append a progress event (JSON-serializable data) to the job's event log."""
+        with self._events_lock:
+            events = self._events.setdefault(job_id, [])
+            events.append({"id": len(events) + 1, "event": event, **data})
+            self._events.move_to_end(job_id)
+            while len(self._events) > JOBS_EVENTS_RETAINED:
+                self._events.popitem(last=False)
+
+    def events_since(self, job_id, last_id=0):
+        """Return the job's events after last_id, or None if its log is no longer in memory."""
+        with self._events_lock:
+            events = self._events.get(job_id)
+            return None if events is None else events[last_id:]
+
+    def update(self, job_id, **fields):
+        """Update job fields (status, stage, total_pages, pages_done, result, error).
+        total_pages/pages_done count the job's units of work: pages for uploads, documents for indexing."""
+        if "result" in fields:
+            fields["result"] = json.dumps(fields["result"])
+        fields["updated_at"] = datetime.utcnow().isoformat()
+        assignments = ", ".join(f"{column} = ?" for column in fields)
+        with self._lock, self._connect() as conn:
+            conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+
+    def increment_pages_done(self, job_id):
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET pages_done = pages_done + 1, updated_at = ? WHERE id = ?",
+                (datetime.utcnow().isoformat(), job_id)
+            )
+
+    def add_total_pages(self, job_id, pages):
+        """Grow total_pages as documents of a multi-file job are opened."""
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET total_pages = COALESCE(total_pages, 0) + ?, updated_at = ? WHERE id = ?",
+                (pages, datetime.utcnow().isoformat(), job_id)
+            )
+
+    def latest(self, user_id, kind, active_only=False):
+        """Return the user's most recent job of a kind (only queued/running ones if active_only), or None."""
+        query = "SELECT id FROM jobs WHERE user_id = ? AND kind = ?"
+        if active_only:
+            query += " AND status IN ('queued', 'running')"
+        with self._connect() as conn:
+            row = conn.execute(query + " ORDER BY created_at DESC LIMIT 1", (user_id, kind)).fetchone()
+        return self.get(row["id"]) if row else None
+
+    def get(self, job_id):
+        """Return the job record as a dict, or None if it doesn't exist."""
+        with self._connect() as conn:
+            row = conn.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if not row:
+            return None
+        job = dict(row)
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
@@ -1,26 +1,36 @@
 from fastapi import FastAPI, File, UploadFile, Request, HTTPException, Depends, Header
-from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, Response
+from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse, Response, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from fastapi.concurrency import run_in_threadpool
 import os
 import shutil
 from pathlib import Path
 import tempfile
-from gemini import process_file, save_summary_to_supabase
+from gemini import (
+    process_file_pages, format_pages, save_summary_to_supabase, save_summaries_to_supabase, save_pages_to_supabase,
+    load_known_pages, update_summary_in_supabase
+)
 from datetime import datetime
-import subprocess
 import json
 import logging
 from rag import RAGSystem
+from jobs import JobQueue, QueueFullError
+from indexing import run_indexing
 from pydantic import BaseModel
 from dotenv import load_dotenv
 from supabase import create_client, Client
-from typing import Optional
+from typing import Optional, List
 import jwt
 from functools import wraps
 import requests
 import base64
+import io
 import time
+import asyncio
+import threading
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 app = FastAPI(title="DigiHealth Document Processor")
 
@@ -81,6 +91,92 @@ DOCUMENTS_BUCKET = "user-documents"  # New bucket for original documents
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_ANON_KEY)
 logger.info("✅ Supabase client initialized successfully")
 
+# Index builds run on their own workers so they never wait behind uploads
+INDEXING_MAX_WORKERS = int(os.getenv("INDEXING_MAX_WORKERS", 2))
+
+# Background queue for document processing and indexing jobs
+job_queue = JobQueue(kind_workers={"indexing": INDEXING_MAX_WORKERS})
+# Serializes the "already indexing?" check with the submit, so double clicks start one job
+indexing_submit_lock = threading.Lock()
+# Storage uploads that run alongside extraction in upload jobs
+STORAGE_UPLOAD_WORKERS = int(os.getenv("STORAGE_UPLOAD_WORKERS", 4))
+storage_executor = ThreadPoolExecutor(max_workers=STORAGE_UPLOAD_WORKERS, thread_name_prefix="storage-upload")
+
+# Bulk upload limits
+ALLOWED_EXTENSIONS = ['.pdf', '.jpg', '.jpeg', '.png']
+BULK_MAX_FILES = int(os.getenv("BULK_MAX_FILES", 100))
+BULK_MAX_TOTAL_BYTES = int(os.getenv("BULK_MAX_TOTAL_BYTES", 200 * 1024 * 1024))
+# Files of a bulk upload processed at the same time
+BULK_FILES_IN_FLIGHT = int(os.getenv("BULK_FILES_IN_FLIGHT", 3))
+# Documents written per batched insert
+BULK_INSERT_BATCH_SIZE = int(os.getenv("BULK_INSERT_BATCH_SIZE", 20))
+# How often the job event stream checks for new events, and sends keep-alives when idle
+JOB_EVENTS_POLL_SECONDS = float(os.getenv("JOB_EVENTS_POLL_SECONDS", 0.25))
+JOB_EVENTS_KEEPALIVE_SECONDS = 15
+# Largest single document accepted by /upload-file and /reprocess-document
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 10 * 1024 * 1024))
+# Allowance for multipart boundaries and headers around the file itself
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+class UploadSizeLimitMiddleware:
+    """Reject upload request bodies over their limit as they stream in, before they are spooled"""
+    
+    def __init__(self, app):
+        self.app = app
+    
+    @staticmethod
+    def body_limit(path: str):
+        if path == "/upload-file" or path.startswith("/reprocess-document/"):
+            return MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES
+        if path == "/upload-files":
+            return BULK_MAX_TOTAL_BYTES + MULTIPART_OVERHEAD_BYTES
+        return None
+    
+    async def __call__(self, scope, receive, send):
+        limit = self.body_limit(scope["path"]) if scope["type"] == "http" else None
+        if limit is None:
+            return await self.app(scope, receive, send)
+        
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None:
+            try:
+                declared = int(content_length)
+                if declared < 0:
+                    raise ValueError(content_length)
+            except ValueError:
+                logger.warning(f"⚠️ Rejected {scope['path']} upload with invalid Content-Length {content_length!r}")
+                response = JSONResponse({"detail": "Invalid Content-Length header"}, status_code=400)
+                return await response(scope, receive, send)
+            if declared > limit:
+                logger.warning(f"⚠️ Rejected {scope['path']} upload of {declared} bytes")
+                response = JSONResponse({"detail": "File is too large"}, status_code=413)
+                return await response(scope, receive, send)
+        
+        # Chunked bodies have no Content-Length, so count bytes as they arrive
+        received = 0
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > limit:
+                    raise HTTPException(status_code=413, detail="File is too large")
+            return message
+        
+        await self.app(scope, limited_receive, send)
+
+app.add_middleware(UploadSizeLimitMiddleware)
+
+async def read_upload(file: UploadFile, max_bytes: int = MAX_UPLOAD_BYTES) -> bytes:
+    """Read an upload into a single buffer, shared by storage upload and extraction"""
+    if file.size is not None and file.size > max_bytes:
+        raise HTTPException(status_code=413, detail=f"File is too large. The limit is {max_bytes // (1024 * 1024)}MB.")
+    # One read of at most max_bytes + 1 bytes both copies the data once and detects oversize files
+    file_data = await file.read(max_bytes + 1)
+    if len(file_data) > max_bytes:
+        raise HTTPException(status_code=413, detail=f"File is too large. The limit is {max_bytes // (1024 * 1024)}MB.")
+    return file_data
+
 # Initialize RAG system - now we'll create user-specific instances
 # rag_system = RAGSystem()  # Remove global RAG system
 
@@ -185,7 +281,7 @@ async def upload_page(request: Request):
 
 @app.post("/upload-file")
 async def upload_file(file: UploadFile = File(...), request: Request = None):
-    """Handle file upload and processing - requires authentication"""
+    """Accept a file upload and queue it for background processing - requires authentication"""
     # Check authentication manually for file uploads
     auth_header = request.headers.get('authorization') if request else None
     if not auth_header:
@@ -213,71 +309,485 @@ async def upload_file(file: UploadFile = File(...), request: Request = None):
         
         logger.info(f"✅ File type validated: {file_extension}")
         
-        # Read file data
-        file_data = await file.read()
+        # Read file data once; the job hands this buffer to both storage and the extractor
+        file_data = await read_upload(file)
         logger.info(f"📄 File data read: {len(file_data)} bytes")
         
-        # Upload original document to Supabase Storage
-        logger.info("📤 Uploading original document to Supabase Storage...")
-        storage_result = upload_document_to_storage(user_id, file_data, file.filename)
+        try:
+            job_id = job_queue.submit(
+                user_id, "upload", process_upload_job, user_id, file.filename, file_data,
+                filename=file.filename
+            )
+        except QueueFullError as e:
+            raise HTTPException(status_code=503, detail=str(e))
         
+        return JSONResponse({
+            "status": "accepted",
+            "message": "File received and queued for processing",
+            "filename": file.filename,
+            "job_id": job_id,
+            "status_url": f"/jobs/{job_id}"
+        }, status_code=202)
+                
+    except HTTPException:
+        # Re-raise HTTP exceptions
+        raise
+    except Exception as e:
+        logger.error(f"❌ Upload failed: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
+
+def job_progress_callback(job_id: str, accumulate_pages: bool = False, **context):
+    """Progress callback for document processing that keeps the job's page counters
+    current and forwards every event (plus context such as filename) to its event stream"""
+    def on_progress(event, **details):
+        if event == "document_opened":
+            if accumulate_pages:
+                job_queue.add_total_pages(job_id, details["pages"])
+            else:
+                job_queue.update(job_id, total_pages=details["pages"])
+        elif event == "page_extracted":
+            job_queue.increment_pages_done(job_id)
+        job_queue.emit(job_id, event, **context, **details)
+    return on_progress
+
+def process_upload_job(job_id: str, user_id: str, filename: str, file_data: bytes):
+    """Background job: store the original document while its pages are extracted, then save the summary"""
+    # Upload the original to Supabase Storage alongside extraction. Duplicates are
+    # reported by the upload itself (409) instead of listing the user's folder first.
+    logger.info("📤 Uploading original document to Supabase Storage in the background...")
+    storage_future = storage_executor.submit(upload_document_to_storage, user_id, file_data, filename, check_existing=False)
+    
+    def storage_error():
+        """Why the storage upload failed, or None while it is running or if it succeeded"""
+        if not storage_future.done() or storage_future.cancelled():
+            return None
+        storage_result = storage_future.result()
         if not storage_result:
-            logger.error("❌ Failed to upload document to storage")
-            raise HTTPException(status_code=500, detail="Failed to upload document to storage")
+            return "Failed to upload document to storage"
+        if isinstance(storage_result, dict):
+            return storage_result.get("message", "Document already exists")
+        return None
+    
+    def on_stored(future):
+        if not future.cancelled() and isinstance(future.result(), str):
+            logger.info(f"✅ Document uploaded to storage: {future.result()}")
+            job_queue.emit(job_id, "stored", filename=filename, storage_path=future.result())
+    
+    storage_future.add_done_callback(on_stored)
+    report_progress = job_progress_callback(job_id, filename=filename)
+    
+    def on_progress(event, **details):
+        # Stop extracting as soon as the upload turns out to be a duplicate or has failed
+        error = storage_error()
+        if error:
+            raise Exception(error)
+        report_progress(event, **details)
+    
+    try:
+        # Process the file using gemini.py logic
+        logger.info("🤖 Starting AI text extraction with Gemini...")
+        job_queue.update(job_id, stage="extracting")
+        
+        pages = process_file_pages(file_data, progress_callback=on_progress, file_name=filename, user_id=user_id)
+        summary = format_pages(pages)
+        logger.info(f"✅ Text extraction completed. Summary length: {len(summary)} characters")
+        
+        # Join the storage upload before the metadata insert references it
+        job_queue.update(job_id, stage="storing")
+        storage_path = storage_future.result()
+        error = storage_error()
+        if error:
+            raise Exception(error)
+        
+        # Save to Supabase with user_id and storage path
+        logger.info("💾 Saving document metadata to Supabase...")
+        job_queue.update(job_id, stage="saving")
+        document_id = save_summary_to_supabase(summary, filename, user_id, supabase, storage_path)
+        logger.info(f"✅ Document metadata saved to Supabase with ID: {document_id}")
+        # The document row now references the stored original, so a failed page
+        # save must not roll it back; pages only let a reprocess reuse unchanged pages
+        try:
+            save_pages_to_supabase(document_id, pages, user_id, supabase)
+        except Exception as e:
+            logger.warning(f"⚠️ Could not save pages for {filename}: {e}")
+        job_queue.emit(job_id, "saved", filename=filename, document_id=document_id)
         
-        # Check if it's a duplicate file error
-        if isinstance(storage_result, dict) and storage_result.get("error") == "duplicate":
-            logger.warning(f"⚠️ Duplicate file detected: {file.filename}")
-            raise HTTPException(
-                status_code=409, 
-                detail=storage_result.get("message", "Document already exists")
-            )
+        return {
+            "status": "success",
+            "message": "File processed and saved successfully!",
+            "filename": filename,
+            "summary": summary,
+            "document_id": document_id,
+            "storage_path": storage_path
+        }
         
-        storage_path = storage_result
-        logger.info(f"✅ Document uploaded to storage: {storage_path}")
+    except Exception as e:
+        logger.error(f"❌ Error processing file: {str(e)}")
+        # Clean up storage if this job stored the original (an upload that hasn't started is just cancelled)
+        if not storage_future.cancel() and isinstance(storage_future.result(), str):
+            delete_document_from_storage(user_id, filename)
+        raise Exception(f"Error processing file: {str(e)}")
+
+def _save_temp_file(file_data: bytes, suffix: str) -> str:
+    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp_file:
+        tmp_file.write(file_data)
+        return tmp_file.name
+
+def _extract_zip_entries(zip_data: bytes, budget: int):
+    """Extract supported documents from a ZIP archive into temp files, enforcing size/count limits"""
+    entries = []
+    with zipfile.ZipFile(io.BytesIO(zip_data)) as archive:
+        for info in archive.infolist():
+            filename = os.path.basename(info.filename)
+            extension = os.path.splitext(filename)[1].lower()
+            if info.is_dir() or not filename or filename.startswith('.') or info.filename.startswith('__MACOSX'):
+                continue
+            if extension not in ALLOWED_EXTENSIONS:
+                logger.warning(f"⚠️ Skipping unsupported ZIP entry: {info.filename}")
+                continue
+            # Check declared sizes before inflating anything
+            budget -= info.file_size
+            if budget < 0:
+                raise HTTPException(status_code=413, detail="Archive contents exceed the bulk upload size limit")
+            entries.append((filename, _save_temp_file(archive.read(info), extension)))
+    return entries, budget
+
+@app.post("/upload-files")
+async def upload_files(files: List[UploadFile] = File(...), request: Request = None):
+    """Accept many files and/or ZIP archives and queue them as one bulk ingest job - requires authentication"""
+    # Check authentication manually for file uploads
+    auth_header = request.headers.get('authorization') if request else None
+    if not auth_header:
+        raise HTTPException(status_code=401, detail="Authentication required")
+    
+    try:
+        user_id = verify_token(auth_header)
+        logger.info(f"📁 Starting bulk upload of {len(files)} files for user: {user_id}")
+    except Exception as e:
+        logger.error(f"❌ Authentication failed: {e}")
+        raise HTTPException(status_code=401, detail="Invalid authentication")
+    
+    entries = []
+    rejected = []
+    try:
+        budget = BULK_MAX_TOTAL_BYTES
+        for file in files:
+            file_extension = os.path.splitext(file.filename)[1].lower()
+            file_data = await file.read()
+            
+            if file_extension == '.zip':
+                logger.info(f"🗜️ Expanding ZIP archive {file.filename}")
+                try:
+                    zip_entries, budget = _extract_zip_entries(file_data, budget)
+                except zipfile.BadZipFile:
+                    rejected.append({"filename": file.filename, "status": "failed", "error": "Invalid ZIP archive"})
+                    continue
+                entries.extend(zip_entries)
+            elif file_extension in ALLOWED_EXTENSIONS:
+                budget -= len(file_data)
+                if budget < 0:
+                    raise HTTPException(status_code=413, detail="Files exceed the bulk upload size limit")
+                entries.append((file.filename, _save_temp_file(file_data, file_extension)))
+            else:
+                rejected.append({"filename": file.filename, "status": "failed", "error": "Unsupported file type"})
+            
+            if len(entries) > BULK_MAX_FILES:
+                raise HTTPException(status_code=413, detail=f"Bulk uploads are limited to {BULK_MAX_FILES} documents")
         
-        # Save uploaded file temporarily for processing
-        with tempfile.NamedTemporaryFile(delete=False, suffix=file_extension) as tmp_file:
-            tmp_file.write(file_data)
-            temp_file_path = tmp_file.name
+        if not entries:
+            raise HTTPException(status_code=400, detail="No supported documents found. Please upload PDF, JPG, JPEG, PNG or ZIP files.")
         
-        logger.info(f"💾 File saved temporarily at: {temp_file_path}")
+        job_id = job_queue.submit(user_id, "bulk_upload", process_bulk_upload_job, user_id, entries, rejected)
         
+        return JSONResponse({
+            "status": "accepted",
+            "message": f"{len(entries)} documents received and queued for processing",
+            "files": [filename for filename, _ in entries],
+            "rejected": rejected,
+            "job_id": job_id,
+            "status_url": f"/jobs/{job_id}"
+        }, status_code=202)
+    
+    except Exception as e:
+        for _, temp_file_path in entries:
+            if os.path.exists(temp_file_path):
+                os.unlink(temp_file_path)
+        if isinstance(e, QueueFullError):
+            raise HTTPException(status_code=503, detail=str(e))
+        if isinstance(e, HTTPException):
+            raise
+        logger.error(f"❌ Bulk upload failed: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Bulk upload failed: {str(e)}")
+
+def process_bulk_upload_job(job_id: str, user_id: str, entries: list, rejected: list):
+    """Background job: pipeline storage upload, extraction and batched inserts across many files"""
+    outcomes = [{"filename": filename, "status": "pending"} for filename, _ in entries]
+    ready = []
+    
+    # One listing of the user's folder covers every file in the batch
+    existing_files = list_user_documents(user_id)
+    seen = set()
+    
+    def ingest(filename: str, temp_file_path: str):
+        # Read each file once; storage and the extractor share the buffer
+        with open(temp_file_path, "rb") as f:
+            file_data = f.read()
+        storage_result = upload_document_to_storage(user_id, file_data, filename, check_existing=False)
+        if not storage_result:
+            raise Exception("Failed to upload document to storage")
+        if isinstance(storage_result, dict):
+            raise Exception(storage_result.get("message", "Document already exists"))
+        job_queue.emit(job_id, "stored", filename=filename, storage_path=storage_result)
         try:
-            # Process the file using gemini.py logic
-            logger.info("🤖 Starting AI text extraction with Gemini...")
-            summary = process_file(temp_file_path)
-            logger.info(f"✅ Text extraction completed. Summary length: {len(summary)} characters")
-            
-            # Save to Supabase with user_id and storage path
-            logger.info("💾 Saving document metadata to Supabase...")
-            document_id = save_summary_to_supabase(summary, file.filename, user_id, supabase, storage_path)
-            logger.info(f"✅ Document metadata saved to Supabase with ID: {document_id}")
-            
-            return JSONResponse({
-                "status": "success",
-                "message": "File processed and saved successfully!",
-                "filename": file.filename,
-                "summary": summary,
-                "document_id": document_id,
-                "storage_path": storage_path
-            })
-            
+            on_progress = job_progress_callback(job_id, accumulate_pages=True, filename=filename)
+            pages = process_file_pages(file_data, progress_callback=on_progress, file_name=filename, user_id=user_id)
+        except Exception:
+            delete_document_from_storage(user_id, filename)
+            raise
+        return storage_result, pages
+    
+    def flush():
+        batch_indexes = [index for index, _ in ready]
+        batch = [item for _, item in ready]
+        ready.clear()
+        try:
+            document_ids = save_summaries_to_supabase([
+                {"summary_text": format_pages(pages), "source_file": filename, "user_id": user_id, "storage_path": storage_path}
+                for filename, storage_path, pages in batch
+            ], supabase)
         except Exception as e:
-            logger.error(f"❌ Error processing file: {str(e)}")
-            # Clean up storage if processing failed
-            delete_document_from_storage(user_id, file.filename)
-            raise HTTPException(status_code=500, detail=f"Error processing file: {str(e)}")
-        
-        finally:
-            # Clean up temporary file
+            # Compensate: nothing in this batch was saved, so drop the stored originals
+            for index, (filename, _, _) in zip(batch_indexes, batch):
+                delete_document_from_storage(user_id, filename)
+                outcomes[index].update(status="failed", error=str(e))
+            return
+        for index, (filename, storage_path, pages), document_id in zip(batch_indexes, batch, document_ids):
+            try:
+                save_pages_to_supabase(document_id, pages, user_id, supabase)
+            except Exception as e:
+                logger.warning(f"⚠️ Could not save pages for {filename}: {e}")
+            outcomes[index].update(status="success", document_id=document_id, storage_path=storage_path)
+            job_queue.emit(job_id, "saved", filename=filename, document_id=document_id)
+    
+    try:
+        job_queue.update(job_id, stage="extracting")
+        with ThreadPoolExecutor(max_workers=BULK_FILES_IN_FLIGHT) as executor:
+            futures = {}
+            for index, (filename, temp_file_path) in enumerate(entries):
+                if filename in existing_files or filename in seen:
+                    outcomes[index].update(status="duplicate", error=f"Document '{filename}' already exists")
+                    continue
+                seen.add(filename)
+                futures[executor.submit(ingest, filename, temp_file_path)] = index
+            
+            for future in as_completed(futures):
+                index = futures[future]
+                filename = entries[index][0]
+                try:
+                    storage_path, pages = future.result()
+                    ready.append((index, (filename, storage_path, pages)))
+                except Exception as e:
+                    logger.error(f"❌ Bulk ingest of {filename} failed: {e}")
+                    outcomes[index].update(status="failed", error=str(e))
+                if len(ready) >= BULK_INSERT_BATCH_SIZE:
+                    flush()
+        
+        job_queue.update(job_id, stage="saving")
+        if ready:
+            flush()
+    
+    finally:
+        for _, temp_file_path in entries:
             if os.path.exists(temp_file_path):
                 os.unlink(temp_file_path)
-                logger.info("🧹 Temporary file cleaned up")
-                
+    
+    results = outcomes + rejected
+    succeeded = sum(1 for outcome in results if outcome["status"] == "success")
+    logger.info(f"✅ Bulk upload finished: {succeeded}/{len(results)} documents saved")
+    return {
+        "status": "success" if succeeded == len(results) else "partial",
+        "message": f"{succeeded} of {len(results)} documents processed and saved",
+        "files": results
+    }
+
+@app.post("/reprocess-document/{document_id}")
+async def reprocess_document(document_id: str, file: UploadFile = File(...), request: Request = None):
+    """Replace a document with a revised file, re-extracting only changed pages - requires authentication"""
+    # Check authentication manually
+    auth_header = request.headers.get('authorization') if request else None
+    if not auth_header:
+        raise HTTPException(status_code=401, detail="Authentication required")
+    
+    try:
+        user_id = verify_token(auth_header)
+        logger.info(f"🔁 Reprocess request for document {document_id} by user: {user_id}")
     except Exception as e:
-        logger.error(f"❌ Upload failed: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
+        logger.error(f"❌ Authentication failed: {e}")
+        raise HTTPException(status_code=401, detail="Invalid authentication")
+    
+    try:
+        response = supabase.table('documents').select('id, file_name, source_path').eq('id', document_id).eq('user_id', user_id).execute()
+        if not response.data:
+            logger.error(f"❌ Document {document_id} not found or access denied")
+            raise HTTPException(status_code=404, detail="Document not found or access denied")
+        document = response.data[0]
+        
+        file_extension = os.path.splitext(file.filename)[1].lower()
+        stored_extension = os.path.splitext(document['file_name'])[1].lower()
+        if file_extension != stored_extension:
+            raise HTTPException(status_code=400, detail=f"Revised file must be a {stored_extension} file")
+        
+        file_data = await read_upload(file)
+        
+        try:
+            job_id = job_queue.submit(
+                user_id, "reprocess", process_reprocess_job, user_id, document_id, document['file_name'], file_data,
+                filename=document['file_name']
+            )
+        except QueueFullError as e:
+            raise HTTPException(status_code=503, detail=str(e))
+        
+        return JSONResponse({
+            "status": "accepted",
+            "message": "Revised file received and queued for processing",
+            "document_id": document_id,
+            "job_id": job_id,
+            "status_url": f"/jobs/{job_id}"
+        }, status_code=202)
+    
+    except HTTPException:
+        # Re-raise HTTP exceptions
+        raise
+    except Exception as e:
+        logger.error(f"❌ Reprocess failed: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Reprocess failed: {str(e)}")
+
+def process_reprocess_job(job_id: str, user_id: str, document_id: str, filename: str, file_data: bytes):
+    """Background job: re-extract only the pages of a revised document whose hash changed"""
+    job_queue.update(job_id, stage="extracting")
+    known_pages = load_known_pages(document_id, supabase)
+    
+    on_progress = job_progress_callback(job_id, filename=filename)
+    pages = process_file_pages(
+        file_data, progress_callback=on_progress, known_pages=known_pages, file_name=filename, user_id=user_id
+    )
+    summary = format_pages(pages)
+    reused = sum(page["reused"] for page in pages)
+    logger.info(f"✅ Reprocessed {len(pages)} pages, {reused} reused unchanged")
+    
+    # Replace the stored original with the revised file
+    job_queue.update(job_id, stage="storing")
+    storage_result = upload_document_to_storage(user_id, file_data, filename, overwrite=True)
+    if not storage_result or isinstance(storage_result, dict):
+        raise Exception("Failed to upload revised document to storage")
+    job_queue.emit(job_id, "stored", filename=filename, storage_path=storage_result)
+    
+    job_queue.update(job_id, stage="saving")
+    save_pages_to_supabase(document_id, pages, user_id, supabase)
+    update_summary_in_supabase(document_id, summary, supabase)
+    job_queue.emit(job_id, "saved", filename=filename, document_id=document_id)
+    
+    return {
+        "status": "success",
+        "message": "Document reprocessed successfully!",
+        "filename": filename,
+        "summary": summary,
+        "document_id": document_id,
+        "pages_total": len(pages),
+        "pages_reused": reused,
+        "pages_extracted": len(pages) - reused
+    }
+
+@app.get("/jobs/{job_id}")
+async def get_job_status(job_id: str, request: Request = None):
+    """Report status, per-page progress, result and errors of a background job - requires authentication"""
+    # Check authentication manually
+    auth_header = request.headers.get('authorization') if request else None
+    if not auth_header:
+        raise HTTPException(status_code=401, detail="Authentication required")
+    
+    try:
+        user_id = verify_token(auth_header)
+    except Exception as e:
+        logger.error(f"❌ Authentication failed: {e}")
+        raise HTTPException(status_code=401, detail="Invalid authentication")
+    
+    job = job_queue.get(job_id)
+    if not job or job["user_id"] != user_id:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    return JSONResponse(job)
+
+def _sse_message(event: dict) -> str:
+    data = {key: value for key, value in event.items() if key not in ("id", "event")}
+    message = f"event: {event['event']}\ndata: {json.dumps(data)}\n\n"
+    return f"id: {event['id']}\n{message}" if "id" in event else message
+
+@app.get("/jobs/{job_id}/events")
+async def stream_job_events(job_id: str, request: Request = None):
+    """Stream a job's progress as server-sent events: storage upload, pages rendered
+    and extracted (with their summaries), saves, and the final result - requires authentication"""
+    # Check authentication manually
+    auth_header = request.headers.get('authorization') if request else None
+    if not auth_header:
+        raise HTTPException(status_code=401, detail="Authentication required")
+    
+    try:
+        user_id = verify_token(auth_header)
+    except Exception as e:
+        logger.error(f"❌ Authentication failed: {e}")
+        raise HTTPException(status_code=401, detail="Invalid authentication")
+    
+    job = job_queue.get(job_id)
+    if not job or job["user_id"] != user_id:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    # Reconnecting clients resume after the last event they saw; a malformed
+    # id replays the stream from the start
+    last_event_id = request.headers.get('last-event-id') or '0'
+    try:
+        last_id = max(0, int(last_event_id))
+    except ValueError:
+        logger.warning(f"⚠️ Ignoring invalid Last-Event-ID {last_event_id!r} for job {job_id}")
+        last_id = 0
+    
+    async def event_stream():
+        nonlocal last_id
+        idle_seconds = 0.0
+        while not await request.is_disconnected():
+            events = job_queue.events_since(job_id, last_id)
+            if events is None:
+                # The event log is gone (server restarted or job is old): fall back to the stored record
+                job = await run_in_threadpool(job_queue.get, job_id)
+                if job["status"] == "completed":
+                    yield _sse_message({"event": "completed", "result": job["result"]})
+                    return
+                if job["status"] == "failed":
+                    yield _sse_message({"event": "failed", "error": job["error"]})
+                    return
+                yield _sse_message({"event": "status", "stage": job["stage"], "pages_done": job["pages_done"], "total_pages": job["total_pages"]})
+                await asyncio.sleep(1)
+                continue
+            
+            for event in events:
+                last_id = event["id"]
+                yield _sse_message(event)
+                if event["event"] in ("completed", "failed"):
+                    return
+            
+            if events:
+                idle_seconds = 0.0
+            elif idle_seconds >= JOB_EVENTS_KEEPALIVE_SECONDS:
+                yield ": keep-alive\n\n"
+                idle_seconds = 0.0
+            await asyncio.sleep(JOB_EVENTS_POLL_SECONDS)
+            idle_seconds += JOB_EVENTS_POLL_SECONDS
+    
+    return StreamingResponse(event_stream(), media_type="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        # Stop reverse proxies from buffering the stream
+        "X-Accel-Buffering": "no"
+    })
 
 @app.get("/index", response_class=HTMLResponse)
 async def index_page(request: Request):
@@ -286,7 +796,7 @@ async def index_page(request: Request):
 
 @app.post("/start-indexing")
 async def start_indexing(request: Request = None):
-    """Start the indexing process - requires authentication"""
+    """Queue an index build for the user (or join the one already running) - requires authentication"""
     # Check authentication manually
     auth_header = request.headers.get('authorization') if request else None
     if not auth_header:
@@ -299,83 +809,93 @@ async def start_indexing(request: Request = None):
         logger.error(f"❌ Authentication failed: {e}")
         raise HTTPException(status_code=401, detail="Invalid authentication")
     
+    with indexing_submit_lock:
+        active_job = job_queue.latest(user_id, "indexing", active_only=True)
+        if active_job:
+            logger.info(f"⏳ Indexing already in progress for user {user_id}: job {active_job['id']}")
+            job_id = active_job["id"]
+            message = "Indexing is already in progress"
+        else:
+            try:
+                job_id = job_queue.submit(user_id, "indexing", process_indexing_job, user_id)
+            except QueueFullError as e:
+                raise HTTPException(status_code=503, detail=str(e))
+            message = "Indexing started"
+    
+    return JSONResponse({
+        "status": "accepted",
+        "message": message,
+        "job_id": job_id,
+        "status_url": "/indexing-status"
+    }, status_code=202)
+
+def process_indexing_job(job_id: str, user_id: str):
+    """Background job: embed new documents and rebuild the user's index in-process"""
+    def on_progress(event, **details):
+        if event == "documents_found":
+            job_queue.update(job_id, stage="embedding", total_pages=details["count"])
+        elif event == "documents_embedded":
+            job_queue.update(job_id, pages_done=details["done"])
+        elif event == "documents_loaded":
+            job_queue.update(job_id, stage="building")
+        elif event == "index_built":
+            job_queue.update(job_id, stage="uploading")
+        job_queue.emit(job_id, event, **details)
+    
+    progress_info = run_indexing(user_id, progress_callback=on_progress)
+    logger.info("✅ Indexing completed successfully")
+    stats = get_document_stats(user_id)
+    return {
+        "status": "success",
+        "message": "Indexing completed successfully",
+        "last_indexed_time": stats["last_indexed_time"],
+        "total_documents": stats["total_documents"],
+        "progress_info": progress_info
+    }
+
+def get_document_stats(user_id: str) -> dict:
+    """Total documents and last indexed time for a user"""
+    logger.info("📊 Fetching document statistics from Supabase...")
     try:
-        # Run the indexing script with user_id
-        logger.info("🚀 Executing indexing script...")
-        result = subprocess.run(
-            ["python", "indexing.py", "--user-id", user_id],
-            capture_output=True,
-            text=True
-        )
-        
-        if result.returncode != 0:
-            error_msg = result.stderr.strip()
-            logger.error(f"❌ Indexing failed: {error_msg}")
-            raise HTTPException(
-                status_code=500,
-                detail=f"Indexing failed: {error_msg}"
-            )
-        
-        logger.info("✅ Indexing script completed successfully")
-        
-        # Parse the output to get progress information
-        output_lines = result.stdout.strip().split('\n')
-        progress_info = {
-            'documents_embedded': 0,
-            'total_documents': 0,
-            'status': 'completed'
+        response = supabase.table('documents').select('indexed_at').eq('user_id', user_id).execute()
+        indexed_times = [doc['indexed_at'] for doc in response.data if doc.get('indexed_at')]
+        stats = {
+            "total_documents": len(response.data),
+            "last_indexed_time": max(indexed_times) if indexed_times else "Never"
         }
-        
-        for line in output_lines:
-            if "Found" in line and "documents to embed" in line:
-                progress_info['documents_embedded'] = int(line.split()[1])
-            elif "Loaded" in line and "documents with embeddings" in line:
-                progress_info['total_documents'] = int(line.split()[1])
-        
-        # Update last indexed time in Supabase for this user
-        logger.info("🕒 Updating indexed timestamp in Supabase...")
-        try:
-            supabase.table('documents').update({
-                'indexed_at': datetime.now().isoformat()
-            }).eq('user_id', user_id).execute()
-            logger.info("✅ Indexed timestamp updated successfully")
-        except Exception as e:
-            logger.warning(f"⚠️ Could not update indexed timestamp: {e}")
-        
-        # Get updated counts for this user from Supabase
-        logger.info("📊 Fetching document statistics from Supabase...")
-        try:
-            response = supabase.table('documents').select('*').eq('user_id', user_id).execute()
-            total_documents = len(response.data)
-            
-            # Get last indexed time
-            indexed_docs = [doc for doc in response.data if doc.get('indexed_at')]
-            last_indexed_time = "Never"
-            if indexed_docs:
-                last_indexed = max(indexed_docs, key=lambda x: x.get('indexed_at', ''))
-                last_indexed_time = last_indexed.get('indexed_at', 'Never')
-            
-            logger.info(f"📈 Document statistics - Total: {total_documents}, Last indexed: {last_indexed_time}")
-            
-        except Exception as e:
-            logger.error(f"❌ Error fetching document statistics: {e}")
-            total_documents = 0
-            last_indexed_time = "Error"
-        
-        return JSONResponse({
-            "status": "success",
-            "message": "Indexing completed successfully",
-            "last_indexed_time": last_indexed_time,
-            "total_documents": total_documents,
-            "progress_info": progress_info
-        })
-        
+        logger.info(f"📈 Document statistics - Total: {stats['total_documents']}, Last indexed: {stats['last_indexed_time']}")
+        return stats
     except Exception as e:
-        logger.error(f"❌ Error during indexing: {str(e)}")
-        raise HTTPException(
-            status_code=500,
-            detail=f"Error during indexing: {str(e)}"
-        )
+        logger.error(f"❌ Error fetching document statistics: {e}")
+        return {"total_documents": 0, "last_indexed_time": "Error"}
+
+@app.get("/indexing-status")
+async def indexing_status(request: Request = None):
+    """Progress of the user's latest index build plus document statistics - requires authentication"""
+    # Check authentication manually
+    auth_header = request.headers.get('authorization') if request else None
+    if not auth_header:
+        raise HTTPException(status_code=401, detail="Authentication required")
+    
+    try:
+        user_id = verify_token(auth_header)
+    except Exception as e:
+        logger.error(f"❌ Authentication failed: {e}")
+        raise HTTPException(status_code=401, detail="Invalid authentication")
+    
+    job = job_queue.latest(user_id, "indexing")
+    stats = await run_in_threadpool(get_document_stats, user_id)
+    return JSONResponse({
+        "job_id": job["id"] if job else None,
+        "status": job["status"] if job else "idle",
+        "stage": job["stage"] if job else None,
+        "documents_to_embed": job["total_pages"] if job else None,
+        "documents_embedded": job["pages_done"] if job else 0,
+        "result": job["result"] if job else None,
+        "error": job["error"] if job else None,
+        "updated_at": job["updated_at"] if job else None,
+        **stats
+    })
 
 @app.get("/query", response_class=HTMLResponse)
 async def query_page(request: Request):
@@ -895,8 +1415,18 @@ async def health_check():
             "error": str(e)
         }, status_code=500)
 
-def upload_document_to_storage(user_id: str, file_data: bytes, filename: str, content_type: str = None):
-    """Upload original document to Supabase Storage"""
+def list_user_documents(user_id: str) -> set:
+    """Return the names of every original document stored for a user"""
+    try:
+        service_supabase = create_client(SUPABASE_URL, os.getenv("SUPABASE_SERVICE_KEY"))
+        return {file_info['name'] for file_info in service_supabase.storage.from_(DOCUMENTS_BUCKET).list(path=user_id)}
+    except Exception as e:
+        logger.warning(f"⚠️ Could not list existing files for user {user_id}: {e}")
+        return set()
+
+def upload_document_to_storage(user_id: str, file_data: bytes, filename: str, content_type: str = None, overwrite: bool = False, check_existing: bool = True):
+    """Upload original document to Supabase Storage (overwrite replaces an existing file;
+    check_existing=False skips the folder listing when the caller already checked)"""
     try:
         file_path = f"{user_id}/{filename}"
         logger.info(f"📤 Uploading document {filename} to storage for user {user_id}")
@@ -912,7 +1442,7 @@ def upload_document_to_storage(user_id: str, file_data: bytes, filename: str, co
         
         # Check if file already exists
         try:
-            existing_files = service_supabase.storage.from_(DOCUMENTS_BUCKET).list(path=user_id)
+            existing_files = [] if overwrite or not check_existing else service_supabase.storage.from_(DOCUMENTS_BUCKET).list(path=user_id)
             for file_info in existing_files:
                 if file_info['name'] == filename:
                     logger.warning(f"⚠️ Document {filename} already exists for user {user_id}")
@@ -935,7 +1465,7 @@ def upload_document_to_storage(user_id: str, file_data: bytes, filename: str, co
         response = service_supabase.storage.from_(DOCUMENTS_BUCKET).upload(
             path=file_path,
             file=file_data,
-            file_options={"content-type": content_type}
+            file_options={"content-type": content_type, "upsert": "true" if overwrite else "false"}
         )
         
         logger.info(f"✅ Successfully uploaded {filename} to storage")
@@ -0,0 +1,154 @@
+import os
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+def page_cache_key(page_data, prompt, model_name):
+    """
+    Content-addressed key for a page result: hash of the page bytes (or text),
+    the prompt and the model name.
+    """
+    if isinstance(page_data, str):
+        page_data = page_data.encode("utf-8")
+    digest = hashlib.sha256()
+    digest.update(model_name.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(prompt.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(page_data)
+    return digest.hexdigest()
+
+
+class PageCache:
+    """
+    Two-tier cache for Gemini page results.
+
+    - Memory tier: small LRU of recent results (disabled when memory_items is 0)
+    - Disk tier: one file per key under cache_dir, evicted least-recently-used
+      once the directory grows past max_disk_bytes (disabled when cache_dir is None)
+    """
+
+    def __init__(self, cache_dir=None, max_disk_bytes=256 * 1024 * 1024, memory_items=256):
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.max_disk_bytes = max_disk_bytes
+        self.memory_items = memory_items
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_bytes = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            self._disk_bytes = sum(path.stat().st_size for path in self.cache_dir.glob("*/*.txt"))
+            logger.info(f"🗄️ Page cache at {self.cache_dir} ({self._disk_bytes} bytes on disk)")
+
+    def _path(self, key):
+        return self.cache_dir / key[:2] / f"{key}.txt"
+
+    def _remember(self, key, value):
+        if self.memory_items <= 0:
+            return
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        """Return the cached result for key, or None on a miss."""
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return self._memory[key]
+
+        if self.cache_dir:
+            path = self._path(key)
+            try:
+                value = path.read_text(encoding="utf-8")
+                # Touch the file so LRU eviction sees it as recently used
+                os.utime(path)
+                with self._lock:
+                    self.disk_hits += 1
+                    self._remember(key, value)
+                return value
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                logger.warning(f"⚠️ Could not read page cache entry {key}: {e}")
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, value):
+        """Store a result in both tiers."""
+        with self._lock:
+            self._remember(key, value)
+
+        if not self.cache_dir:
+            return
+
+        path = self._path(key)
+        try:
+            path.parent.mkdir(exist_ok=True)
+            data = value.encode("utf-8")
+            old_size = path.stat().st_size if path.exists() else 0
+            tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, path)
+            with self._lock:
+                self._disk_bytes += len(data) - old_size
+                over_budget = self._disk_bytes > self.max_disk_bytes
+            if over_budget:
+                self._evict()
+        except Exception as e:
+            logger.warning(f"⚠️ Could not write page cache entry {key}: {e}")
+
+    def _evict(self):
+        """Delete least-recently-used files until the disk tier fits its budget."""
+        with self._lock:
+            entries = []
+            for path in self.cache_dir.glob("*/*.txt"):
+                try:
+                    stat = path.stat()
+                    entries.append((stat.st_mtime, stat.st_size, path))
+                except FileNotFoundError:
+                    continue
+            entries.sort()
+            total = sum(size for _, size, _ in entries)
+            # Evict down to 90% of the budget so we don't rescan on every write
+            target = int(self.max_disk_bytes * 0.9)
+            removed = 0
+            for _, size, path in entries:
+                if total <= target:
+                    break
+                try:
+                    path.unlink()
+                    total -= size
+                    removed += 1
+                except FileNotFoundError:
+                    continue
+            self._disk_bytes = total
+        logger.info(f"🧹 Evicted {removed} page cache entries ({total} bytes remaining)")
+
+    def stats(self):
+        """Hit/miss counters and current tier sizes."""
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+                "memory_items": len(self._memory),
+                "disk_bytes": self._disk_bytes
+            }
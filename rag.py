@@ -11,6 +11,8 @@ import os
 from supabase import create_client, Client
 import tempfile
 import io
+import json
+from index_utils import apply_search_params, exclusion_params, read_bundle_layout, load_bundle_file, write_bundle_file, spec_quantization, INDEX_POINTER_FILENAME
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -31,12 +33,17 @@ class RAGSystem:
 
         # Storage bucket configuration
         self.STORAGE_BUCKET = "user-indexes"
+        self.INDEX_BUNDLE_FILENAME = "index.bundle"
+        # Downloaded index bundles are kept here and memory-mapped
+        self.INDEX_CACHE_DIR = os.getenv("INDEX_CACHE_DIR", os.path.join(tempfile.gettempdir(), "digihealth-indexes"))
         self.user_id = user_id
 
         self.OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
         self.EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-small")
         self.GPT_MODEL = os.getenv("GPT_MODEL", "gpt-4")
         self.TOP_K = int(os.getenv("TOP_K", 3))
+        # Chunks retrieved per query; they are grouped into at most TOP_K documents
+        self.TOP_K_CHUNKS = int(os.getenv("TOP_K_CHUNKS", 8))
         # --------------------------------------------
 
         self._initialize_components()
@@ -54,9 +61,10 @@ class RAGSystem:
             logger.info("🔗 Initializing Supabase client...")
             self.supabase = create_client(self.SUPABASE_URL, self.SUPABASE_ANON_KEY)
             
-            # Initialize index and doc_ids as None
+            # Initialize index and its id map (chunk ids) as None
             self.index = None
             self.doc_ids = []
+            self.search_params = None
             
             logger.info("✅ RAG system initialized successfully")
             
@@ -66,6 +74,8 @@ class RAGSystem:
 
     def load_user_index(self, user_id: str) -> bool:
         """Load user-specific index from Supabase Storage"""
+        temp_idx_path = None
+        temp_pkl_path = None
         try:
             logger.info(f"📥 Loading index for user: {user_id}")
             
@@ -78,10 +88,34 @@ class RAGSystem:
             # Create service client for storage operations
             service_supabase = create_client(self.SUPABASE_URL, SUPABASE_SERVICE_KEY)
             
-            # Download FAISS index from storage
-            temp_idx_path = None
-            temp_pkl_path = None
+            # Indexes are published as versioned bundles named by a pointer object;
+            # a version already in the local cache isn't downloaded again
+            try:
+                pointer = json.loads(service_supabase.storage.from_(self.STORAGE_BUCKET).download(f"{user_id}/{INDEX_POINTER_FILENAME}"))
+            except Exception as e:
+                logger.info(f"ℹ️ No published index for user {user_id} ({e}), looking for older index files")
+            else:
+                bundle_path = os.path.join(self.INDEX_CACHE_DIR, f"{user_id}-{pointer['version']}.bundle")
+                if os.path.exists(bundle_path):
+                    logger.info(f"✅ Index version {pointer['version']} is already cached")
+                    try:
+                        return self._load_bundle(user_id, bundle_path)
+                    except FileNotFoundError:
+                        # Removed by another request's cache cleanup since the check
+                        logger.info(f"ℹ️ Cached index version {pointer['version']} was removed, downloading it again")
+                logger.info(f"📥 Downloading index version {pointer['version']} ({pointer['compressed_bytes'] / 2**20:.1f} MB)")
+                bundle_data = service_supabase.storage.from_(self.STORAGE_BUCKET).download(f"{user_id}/{pointer['object']}")
+                return self._load_bundle(user_id, self._cache_bundle(user_id, bundle_data))
+            
+            # Bundles stored before versioned publishing
+            try:
+                bundle_data = service_supabase.storage.from_(self.STORAGE_BUCKET).download(f"{user_id}/{self.INDEX_BUNDLE_FILENAME}")
+            except Exception as e:
+                logger.info(f"ℹ️ No index bundle for user {user_id} ({e}), loading separate index files")
+            else:
+                return self._load_bundle(user_id, self._cache_bundle(user_id, bundle_data))
             
+            # Download FAISS index from storage
             try:
                 faiss_path = f"{user_id}/faiss_index.idx"
                 logger.info(f"📥 Downloading FAISS index from {faiss_path}")
@@ -118,6 +152,18 @@ class RAGSystem:
                 logger.error(f"❌ Error loading ID map: {e}")
                 return False
             
+            # Apply the search-time parameters (efSearch/nprobe) stored with the
+            # index; indexes built before index selection are flat and have none
+            try:
+                params_data = service_supabase.storage.from_(self.STORAGE_BUCKET).download(f"{user_id}/index_params.json")
+                self.index_spec = json.loads(params_data)
+                apply_search_params(self.index, self.index_spec.get("search"))
+                logger.info(f"✅ Using {self.index_spec['type']} index with search parameters {self.index_spec.get('search')}")
+            except Exception as e:
+                self.index_spec = None
+                logger.info(f"ℹ️ No index parameters loaded ({e}), searching with defaults")
+            
+            self.search_params = exclusion_params(self.index_spec, self.doc_ids)
             logger.info(f"✅ Successfully loaded index for user {user_id}")
             return True
             
@@ -140,6 +186,66 @@ class RAGSystem:
                 except Exception as e:
                     logger.warning(f"⚠️ Could not delete temporary ID map file: {e}")
 
+    def _cache_bundle(self, user_id: str, bundle_data: bytes) -> str:
+        """Decompress a downloaded index bundle into the local cache and return its path"""
+        os.makedirs(self.INDEX_CACHE_DIR, exist_ok=True)
+        # Written under a temporary name and renamed, so no reader ever maps a partial file
+        with tempfile.NamedTemporaryFile(dir=self.INDEX_CACHE_DIR, suffix='.tmp', delete=False) as temp_bundle:
+            try:
+                write_bundle_file(bundle_data, temp_bundle)
+                temp_bundle.flush()
+                manifest, _ = read_bundle_layout(np.memmap(temp_bundle.name, dtype=np.uint8, mode='r'))
+            except Exception:
+                os.unlink(temp_bundle.name)
+                raise
+        bundle_path = os.path.join(self.INDEX_CACHE_DIR, f"{user_id}-{manifest['index_version']}.bundle")
+        os.replace(temp_bundle.name, bundle_path)
+        return bundle_path
+
+    def _load_bundle(self, user_id: str, bundle_path: str) -> bool:
+        """Memory-map the index and id map from a cached index bundle"""
+        try:
+            index, doc_ids, manifest = load_bundle_file(bundle_path)
+        except FileNotFoundError:
+            raise
+        except Exception as e:
+            logger.error(f"❌ Error loading index bundle: {e}")
+            return False
+        
+        if manifest.get("embedding_model") != self.EMBEDDING_MODEL:
+            logger.error(f"❌ Index was built with {manifest.get('embedding_model')} embeddings but queries use {self.EMBEDDING_MODEL}; re-index the user's documents")
+            return False
+        
+        self._remove_old_bundles(user_id, bundle_path)
+        
+        self.index, self.doc_ids, self.index_spec = index, doc_ids, manifest["spec"]
+        apply_search_params(self.index, self.index_spec.get("search"))
+        self.search_params = exclusion_params(self.index_spec, self.doc_ids)
+        logger.info(f"✅ Loaded {self.index_spec['type']} index ({spec_quantization(manifest['spec'])} vectors) version {manifest['index_version']} for user {user_id} "
+                    f"({len(self.doc_ids)} ids, {self.index.ntotal} vectors, built {manifest['built_at']}, search parameters {self.index_spec.get('search')})")
+        return True
+
+    def _remove_old_bundles(self, user_id: str, bundle_path: str):
+        """
+        Remove cached versions of the user's bundle older than the previous one.
+        The previous version is kept because a concurrent request may have read
+        the old pointer and not mapped its bundle yet (indexes already mapping a
+        removed bundle keep working until they are released).
+        """
+        cached = []
+        for entry in os.scandir(self.INDEX_CACHE_DIR):
+            if entry.name.startswith(f"{user_id}-") and entry.name.endswith(".bundle") and entry.path != bundle_path:
+                try:
+                    cached.append((entry.stat().st_mtime, entry.name))
+                except FileNotFoundError:
+                    pass
+        for _, name in sorted(cached, reverse=True)[1:]:
+            try:
+                os.unlink(os.path.join(self.INDEX_CACHE_DIR, name))
+                logger.info(f"🧹 Removed cached index bundle {name}")
+            except OSError as e:
+                logger.warning(f"⚠️ Could not remove cached index bundle {name}: {e}")
+
     def check_user_has_index(self, user_id: str) -> bool:
         """Check if user has an index in storage"""
         try:
@@ -153,9 +259,8 @@ class RAGSystem:
             service_supabase = create_client(self.SUPABASE_URL, SUPABASE_SERVICE_KEY)
             
             files = service_supabase.storage.from_(self.STORAGE_BUCKET).list(path=user_id)
-            has_faiss = any(file['name'] == 'faiss_index.idx' for file in files)
-            has_id_map = any(file['name'] == 'id_map.pkl' for file in files)
-            return has_faiss and has_id_map
+            names = {file['name'] for file in files}
+            return bool({INDEX_POINTER_FILENAME, self.INDEX_BUNDLE_FILENAME} & names) or {'faiss_index.idx', 'id_map.pkl'} <= names
         except Exception as e:
             logger.error(f"❌ Error checking user index: {e}")
             return False
@@ -195,15 +300,27 @@ class RAGSystem:
             
             # Search FAISS index
             logger.info("🔍 Performing vector search with FAISS...")
-            D, I = self.index.search(query_vector, self.TOP_K)
+            # Vectors of removed chunks still in an HNSW graph are excluded by search_params
+            D, I = self.index.search(query_vector, self.TOP_K_CHUNKS, params=self.search_params)
             
-            # Get top-k document IDs using ID map
-            top_doc_ids = [self.doc_ids[i] for i in I[0]]
-            logger.info(f"📄 Found {len(top_doc_ids)} relevant documents")
+            # Get top-k chunk IDs using ID map. FAISS returns -1 when fewer than
+            # TOP_K_CHUNKS vectors exist.
+            hits = [(self.doc_ids[i], float(D[0][rank])) for rank, i in enumerate(I[0]) if i >= 0 and self.doc_ids[i] is not None]
+            distances = dict(hits)
+            logger.info(f"📄 Found {len(hits)} relevant chunks")
             
-            # Fetch documents from Supabase
+            # Fetch chunks and their documents from Supabase
             logger.info("📊 Fetching documents from Supabase...")
             try:
+                chunks = self.supabase.table('document_chunks').select('id, document_id, page_label, content').in_('id', list(distances)).execute().data
+                if chunks:
+                    # Best (lowest) distance first; documents are ranked by their best chunk
+                    chunks.sort(key=lambda chunk: distances[chunk['id']])
+                    top_doc_ids = list(dict.fromkeys(chunk['document_id'] for chunk in chunks))[:self.TOP_K]
+                else:
+                    # Indexes built before chunking map vectors to document ids
+                    top_doc_ids = [doc_id for doc_id, _ in hits[:self.TOP_K]]
+                
                 response = self.supabase.table('documents').select('*').in_('id', top_doc_ids).execute()
                 all_docs = response.data
                 
@@ -214,21 +331,26 @@ class RAGSystem:
                 
                 # Add similarity scores to documents
                 top_docs = []
-                for doc in all_docs:
-                    if doc['id'] in top_doc_ids:
-                        idx = top_doc_ids.index(doc['id'])
-                        distance = float(D[0][idx])
-                        
-                        # Convert distance to similarity percentage
-                        # FAISS L2 distance: lower = more similar
-                        # Convert to similarity: 1 / (1 + distance) gives 0-1 range
-                        # Then multiply by 100 for percentage
-                        similarity_score = 1 / (1 + distance) * 100
-                        
-                        doc['similarity_score'] = similarity_score
-                        top_docs.append(doc)
+                for doc in sorted(all_docs, key=lambda doc: top_doc_ids.index(doc['id'])):
+                    doc_chunks = [chunk for chunk in chunks if chunk['document_id'] == doc['id']]
+                    distance = distances[doc_chunks[0]['id']] if doc_chunks else distances[doc['id']]
+                    
+                    # Convert distance to similarity percentage
+                    # FAISS L2 distance: lower = more similar
+                    # Convert to similarity: 1 / (1 + distance) gives 0-1 range
+                    # Then multiply by 100 for percentage
+                    doc['similarity_score'] = 1 / (1 + distance) * 100
+                    doc['chunks'] = [
+                        {
+                            "page_label": chunk['page_label'],
+                            "content": chunk['content'],
+                            "similarity_score": 1 / (1 + distances[chunk['id']]) * 100
+                        }
+                        for chunk in doc_chunks
+                    ]
+                    top_docs.append(doc)
                 
-                logger.info(f"✅ Retrieved {len(top_docs)} documents with similarity scores")
+                logger.info(f"✅ Retrieved {len(top_docs)} documents with {sum(len(doc['chunks']) for doc in top_docs)} matching chunks")
                 return top_docs
                 
             except Exception as e:
@@ -244,13 +366,23 @@ class RAGSystem:
         try:
             logger.info("🤖 Generating response with GPT...")
             
-            # Format context
-            context = "\n\n".join([doc.get("summary", "") for doc in context_docs])
+            # Format context: only the matching chunks of each document (whole
+            # summaries for documents found through a pre-chunking index)
+            sections = []
+            for doc in context_docs:
+                file_name = doc.get("file_name", "Unknown")
+                if doc.get("chunks"):
+                    for chunk in doc["chunks"]:
+                        source = f"{file_name}, {chunk['page_label']}" if chunk["page_label"] else file_name
+                        sections.append(f"[{source}]\n{chunk['content']}")
+                else:
+                    sections.append(f"[{file_name}]\n{doc.get('summary', '')}")
+            context = "\n\n".join(sections)
             
             # Build GPT prompt
-            prompt = f"""Use the following summaries to answer the question. If the information is not available in the summaries, say so.
+            prompt = f"""Use the following excerpts from document summaries to answer the question. If the information is not available in the excerpts, say so.
 
-Summaries:
+Excerpts:
 {context}
 
 Question: {query}
@@ -271,7 +403,8 @@ Answer:"""
                         "document_id": str(doc["id"]),
                         "filename": doc.get("file_name", "Unknown"),
                         "similarity_score": doc["similarity_score"],
-                        "summary": doc.get("summary", "")
+                        "summary": doc.get("summary", ""),
+                        "chunks": doc.get("chunks", [])
                     }
                     for doc in context_docs
                 ]
@@ -8,6 +8,7 @@ document.addEventListener('DOMContentLoaded', function() {
     const uploadError = document.getElementById('uploadError');
     const progressFill = document.getElementById('progressFill');
     const progressText = document.getElementById('progressText');
+    const pagePreview = document.getElementById('pagePreview');
 
     // Only initialize upload functionality if we're on the upload page
     if (!uploadArea) return;
@@ -19,15 +20,13 @@ document.addEventListener('DOMContentLoaded', function() {
         // Create a new file input to ensure change event fires
         const newFileInput = document.createElement('input');
         newFileInput.type = 'file';
-        newFileInput.accept = '.pdf,.jpg,.jpeg,.png';
+        newFileInput.accept = '.pdf,.jpg,.jpeg,.png,.zip';
+        newFileInput.multiple = true;
         newFileInput.style.display = 'none';
         
         // Add change event listener to new input
         newFileInput.addEventListener('change', (e) => {
-            const file = e.target.files[0];
-            if (file) {
-                uploadFile(file);
-            }
+            handleFiles(e.target.files);
             // Clean up the temporary input
             document.body.removeChild(newFileInput);
         });
@@ -46,15 +45,13 @@ document.addEventListener('DOMContentLoaded', function() {
         // Create a new file input to ensure change event fires
         const newFileInput = document.createElement('input');
         newFileInput.type = 'file';
-        newFileInput.accept = '.pdf,.jpg,.jpeg,.png';
+        newFileInput.accept = '.pdf,.jpg,.jpeg,.png,.zip';
+        newFileInput.multiple = true;
         newFileInput.style.display = 'none';
         
         // Add change event listener to new input
         newFileInput.addEventListener('change', (e) => {
-            const file = e.target.files[0];
-            if (file) {
-                uploadFile(file);
-            }
+            handleFiles(e.target.files);
             // Clean up the temporary input
             document.body.removeChild(newFileInput);
         });
@@ -79,11 +76,21 @@ document.addEventListener('DOMContentLoaded', function() {
         e.preventDefault();
         uploadArea.classList.remove('dragover');
         
-        const files = e.dataTransfer.files;
-        if (files.length > 0) {
+        handleFiles(e.dataTransfer.files);
+    });
+
+    // Single documents use /upload-file; several files or a ZIP go through bulk ingest
+    function handleFiles(files) {
+        if (!files || files.length === 0) {
+            return;
+        }
+        const isZip = files[0].name.toLowerCase().endsWith('.zip');
+        if (files.length > 1 || isZip) {
+            uploadFiles(Array.from(files));
+        } else {
             uploadFile(files[0]);
         }
-    });
+    }
 
     // File upload function
     function uploadFile(file) {
@@ -115,16 +122,7 @@ document.addEventListener('DOMContentLoaded', function() {
         const formData = new FormData();
         formData.append('file', file);
 
-        // Simulate progress for better UX
-        let progress = 0;
-        const progressInterval = setInterval(() => {
-            progress += Math.random() * 15;
-            if (progress > 90) {
-                progress = 90;
-                clearInterval(progressInterval);
-            }
-            updateProgress(progress, 'Uploading and processing...');
-        }, 200);
+        updateProgress(5, 'Uploading...');
 
         // Get auth headers
         const headers = {};
@@ -132,16 +130,13 @@ document.addEventListener('DOMContentLoaded', function() {
             headers['Authorization'] = `Bearer ${window.authManager.token}`;
         }
 
-        // Upload file
+        // Upload file; the server queues it and answers 202 with a job id
         fetch('/upload-file', {
             method: 'POST',
             headers: headers,
             body: formData
         })
         .then(response => {
-            clearInterval(progressInterval);
-            updateProgress(95, 'Processing complete...');
-            
             if (!response.ok) {
                 if (response.status === 401) {
                     // Authentication error
@@ -159,17 +154,261 @@ document.addEventListener('DOMContentLoaded', function() {
             return response.json();
         })
         .then(data => {
+            updateProgress(10, 'Queued for processing...');
+            return followJob(data.job_id, headers);
+        })
+        .then(result => {
             updateProgress(100, 'Upload complete!');
             setTimeout(() => {
-                showSuccess(data);
+                showSuccess(result);
             }, 500);
         })
         .catch(error => {
-            clearInterval(progressInterval);
             showError(error.detail || 'An error occurred while uploading the file.');
         });
     }
 
+    // Bulk upload function
+    function uploadFiles(files) {
+        // Check authentication
+        if (!window.authManager || !window.authManager.isAuthenticated) {
+            showError('Please login to upload files.');
+            return;
+        }
+
+        // Validate total size (max 200MB)
+        const maxTotalSize = 200 * 1024 * 1024;
+        const totalSize = files.reduce((sum, file) => sum + file.size, 0);
+        if (totalSize > maxTotalSize) {
+            showError('Files too large. Please upload less than 200MB at a time.');
+            return;
+        }
+
+        hideAllSections();
+        uploadProgress.style.display = 'block';
+
+        const formData = new FormData();
+        files.forEach(file => formData.append('files', file));
+
+        updateProgress(5, `Uploading ${files.length} file(s)...`);
+
+        const headers = {};
+        if (window.authManager && window.authManager.token) {
+            headers['Authorization'] = `Bearer ${window.authManager.token}`;
+        }
+
+        fetch('/upload-files', {
+            method: 'POST',
+            headers: headers,
+            body: formData
+        })
+        .then(response => {
+            if (!response.ok) {
+                if (response.status === 401) {
+                    window.authManager.clearAuthData();
+                    window.authManager.updateUI();
+                    return Promise.reject({ detail: 'Session expired. Please login again.' });
+                }
+                return response.json().then(err => Promise.reject(err));
+            }
+            return response.json();
+        })
+        .then(data => {
+            updateProgress(10, `${data.files.length} document(s) queued for processing...`);
+            return followJob(data.job_id, headers);
+        })
+        .then(result => {
+            updateProgress(100, 'Upload complete!');
+            setTimeout(() => {
+                showBulkSuccess(result);
+            }, 500);
+        })
+        .catch(error => {
+            showError(error.detail || 'An error occurred while uploading the files.');
+        });
+    }
+
+    // Show per-file outcomes of a bulk upload
+    function showBulkSuccess(result) {
+        hideAllSections();
+        uploadResult.style.display = 'block';
+
+        document.getElementById('resultFileName').textContent = result.message;
+        document.getElementById('summaryContent').textContent = result.files
+            .map(file => {
+                const icon = file.status === 'success' ? '✅' : (file.status === 'duplicate' ? '⚠️' : '❌');
+                return `${icon} ${file.filename}${file.error ? ' — ' + file.error : ''}`;
+            })
+            .join('\n');
+    }
+
+    // Follow a background job through its event stream, falling back to polling
+    function followJob(jobId, headers) {
+        if (!window.ReadableStream || !window.TextDecoder) {
+            return pollJob(jobId, headers);
+        }
+        return streamJob(jobId, headers).catch(error => {
+            if (error && error.jobFailed) {
+                return Promise.reject(error);
+            }
+            console.warn('Job event stream unavailable, polling instead:', error);
+            return pollJob(jobId, headers);
+        });
+    }
+
+    // Read the job's server-sent events with fetch (EventSource can't send the auth header)
+    function streamJob(jobId, headers) {
+        const state = { pagesDone: 0, totalPages: 0, filesSaved: 0 };
+        clearPagePreview();
+
+        return fetch(`/jobs/${jobId}/events`, { headers: headers }).then(response => {
+            if (!response.ok || !response.body) {
+                return Promise.reject({ detail: `Event stream failed (${response.status})` });
+            }
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+
+            const read = () => reader.read().then(({ done, value }) => {
+                if (done) {
+                    return Promise.reject({ detail: 'Event stream ended early' });
+                }
+                buffer += decoder.decode(value, { stream: true });
+                const messages = buffer.split('\n\n');
+                buffer = messages.pop();
+
+                for (const message of messages) {
+                    const event = parseEventMessage(message);
+                    if (!event) continue;
+                    if (event.name === 'completed') {
+                        reader.cancel();
+                        return event.data.result;
+                    }
+                    if (event.name === 'failed') {
+                        reader.cancel();
+                        return Promise.reject({ detail: event.data.error || 'Processing failed.', jobFailed: true });
+                    }
+                    renderJobEvent(event.name, event.data, state);
+                }
+                return read();
+            });
+            return read();
+        });
+    }
+
+    function parseEventMessage(message) {
+        let name = 'message';
+        const dataLines = [];
+        message.split('\n').forEach(line => {
+            if (line.startsWith('event:')) name = line.slice(6).trim();
+            else if (line.startsWith('data:')) dataLines.push(line.slice(5).trim());
+        });
+        if (!dataLines.length) return null;  // keep-alive comment
+        return { name: name, data: JSON.parse(dataLines.join('\n')) };
+    }
+
+    // Update the progress bar and page previews from one job event
+    function renderJobEvent(name, data, state) {
+        const fileLabel = data.filename ? `${data.filename}: ` : '';
+        switch (name) {
+            case 'queued':
+                updateProgress(10, 'Queued for processing...');
+                break;
+            case 'started':
+                updateProgress(12, 'Starting...');
+                break;
+            case 'stored':
+                updateProgress(15, `${fileLabel}Original document stored`);
+                break;
+            case 'document_opened':
+                state.totalPages += data.pages;
+                break;
+            case 'page_rendered':
+                updateProgress(pagePercent(state), `${fileLabel}Reading ${data.label.replace('_', ' ')}...`);
+                break;
+            case 'page_extracted':
+                state.pagesDone += 1;
+                updateProgress(pagePercent(state), `${fileLabel}Extracted page ${state.pagesDone} of ${state.totalPages}`);
+                appendPagePreview(fileLabel, data.section);
+                break;
+            case 'saved':
+                state.filesSaved += 1;
+                updateProgress(95, `${fileLabel}Summary saved`);
+                break;
+            case 'status':
+                // Sent when the server no longer holds the event log
+                if (data.total_pages) {
+                    state.pagesDone = data.pages_done;
+                    state.totalPages = data.total_pages;
+                }
+                updateProgress(pagePercent(state), 'Processing...');
+                break;
+        }
+    }
+
+    function pagePercent(state) {
+        return state.totalPages ? 20 + Math.round(70 * state.pagesDone / state.totalPages) : 20;
+    }
+
+    function appendPagePreview(fileLabel, section) {
+        if (!pagePreview) return;
+        pagePreview.style.display = 'block';
+        pagePreview.textContent += (fileLabel ? `\n${fileLabel}` : '') + section + '\n';
+        pagePreview.scrollTop = pagePreview.scrollHeight;
+    }
+
+    function clearPagePreview() {
+        if (!pagePreview) return;
+        pagePreview.textContent = '';
+        pagePreview.style.display = 'none';
+    }
+
+    // Poll a background job until it completes, updating the progress bar
+    function pollJob(jobId, headers) {
+        const stageLabels = {
+            queued: 'Queued for processing...',
+            running: 'Starting...',
+            storing: 'Storing original document...',
+            extracting: 'Extracting text',
+            saving: 'Saving summary...'
+        };
+
+        return new Promise((resolve, reject) => {
+            const poll = () => {
+                fetch(`/jobs/${jobId}`, { headers: headers })
+                    .then(response => {
+                        if (!response.ok) {
+                            return response.json().then(err => Promise.reject(err));
+                        }
+                        return response.json();
+                    })
+                    .then(job => {
+                        if (job.status === 'completed') {
+                            resolve(job.result);
+                            return;
+                        }
+                        if (job.status === 'failed') {
+                            reject({ detail: job.error || 'Processing failed.' });
+                            return;
+                        }
+
+                        let percent = 15;
+                        let text = stageLabels[job.stage] || 'Processing...';
+                        if (job.stage === 'extracting' && job.total_pages) {
+                            percent = 20 + Math.round(70 * job.pages_done / job.total_pages);
+                            text = `${text} (page ${job.pages_done} of ${job.total_pages})...`;
+                        } else if (job.stage === 'saving') {
+                            percent = 95;
+                        }
+                        updateProgress(percent, text);
+                        setTimeout(poll, 1000);
+                    })
+                    .catch(reject);
+            };
+            poll();
+        });
+    }
+
     // Update progress bar
     function updateProgress(percent, text) {
         progressFill.style.width = percent + '%';
@@ -225,6 +464,7 @@ document.addEventListener('DOMContentLoaded', function() {
         // Reset progress
         progressFill.style.width = '0%';
         progressText.textContent = 'Uploading...';
+        clearPagePreview();
     };
 });
 